@@ -0,0 +1,139 @@
+"""cli subscribes log groups from outside of Lambda.
+
+The Lambda function modifies at most MAX_SUBSCRIPTIONS_PER_INVOCATION log groups per invocation and
+chains invocations through EventBridge, which makes the initial onboarding of accounts with many
+log groups slow. cli runs the same reconciliation in a single process, with local AWS credentials,
+many log groups at a time and no invocation budget. Once it has finished, the Lambda function only
+needs to handle new log groups.
+
+Run it from the lambda directory:
+
+    python -m cli create --destination-arn <arn> --role-arn <arn> --filter-name <name>
+
+A line of JSON is written to stdout for each modified log group, in name order, followed by a
+summary. If the run is interrupted, pass the name of the last reported log group to
+--start-log-group to resume from it. That log group is visited again, which does no harm.
+
+With --state-table, progress is journaled in the table shared with the Lambda function, and the
+journal is left in place once the run finishes. Apply the module afterwards with the same
+configuration, and its initial run skips every log group the CLI already handled, then clears
+the journal.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import typing
+
+import boto3
+import botocore.config
+
+import index
+
+
+def parse_args(argv: typing.List[str]) -> argparse.Namespace:
+    def env(name: str, default: str = '') -> str:
+        return os.environ.get(name, default)
+
+    parser = argparse.ArgumentParser(
+        prog='python -m cli',
+        description='Create or delete subscription filters for all matching log groups.')
+    parser.add_argument('action', choices=['create', 'delete'])
+    parser.add_argument('--log-group-matches', default=env('LOG_GROUP_MATCHES', '.*'),
+                        help='comma-separated regex patterns of log groups to subscribe to')
+    parser.add_argument('--log-group-excludes', default=env('LOG_GROUP_EXCLUDES'),
+                        help='comma-separated regex patterns of log groups not to subscribe to')
+    parser.add_argument('--log-group-tag-selectors', default=env('LOG_GROUP_TAG_SELECTORS'),
+                        help='comma-separated tag selectors, "key=value" or "key"')
+    parser.add_argument('--destination-arn', default=env('DESTINATION_ARN'))
+    parser.add_argument('--destination-arn-pool', default=env('DESTINATION_ARN_POOL'),
+                        help='comma-separated destination ARNs among which log groups are spread, '
+                             'replacing --destination-arn')
+    parser.add_argument('--role-arn', default=env('DELIVERY_STREAM_ROLE_ARN'))
+    parser.add_argument('--filter-name', default=env('FILTER_NAME', 'observe-logs-subscription'))
+    parser.add_argument('--filter-pattern', default=env('FILTER_PATTERN'))
+    parser.add_argument('--additional-subscriptions', default=env('ADDITIONAL_SUBSCRIPTIONS'),
+                        help='JSON list of additional subscription configurations')
+    parser.add_argument('--start-log-group', default=None,
+                        help='start at this log group, skipping those whose names sort before it')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of log groups to modify at a time')
+    parser.add_argument('--state-table', default=env('STATE_TABLE_NAME'),
+                        help='DynamoDB table in which to journal progress, shared with the Lambda function')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    if (args.destination_arn == '' and args.destination_arn_pool == '') or args.role_arn == '':
+        parser.error('--destination-arn or --destination-arn-pool, and --role-arn are required')
+    return args
+
+
+def run(client_wrapper: index.AWSWrapper,
+        is_create: bool,
+        configs: typing.List[index.SubscriptionConfig],
+        start_log_group: typing.Optional[str],
+        concurrency: int,
+        journal: typing.Optional[index.ProgressJournal],
+        out: typing.TextIO) -> bool:
+    """run modifies the subscription filters of all log groups selected by configs, writing progress
+    to out. It returns False if any log group could not be modified.
+
+    If journal is not None, it is left in place for the Lambda function's initial run to skip
+    the log groups that were modified.
+    """
+    lock = threading.Lock()
+    count = 0
+
+    def progress(name: str, ok: bool) -> None:
+        nonlocal count
+        with lock:
+            count += 1
+            out.write(json.dumps({'logGroupName': name, 'ok': ok, 'count': count}) + '\n')
+            out.flush()
+
+    failures = index.FailureTracker()
+    _, ok = index.modify_subscriptions(
+        client_wrapper, is_create, configs, start_log_group, journal=journal, failures=failures,
+        max_log_groups=None, concurrency=concurrency, progress=progress)
+    out.write(json.dumps({'ok': ok, 'count': count, 'failed': failures.summary}) + '\n')
+    out.flush()
+    return ok and failures.summary['count'] == 0
+
+
+def main(argv: typing.List[str]) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(stream=sys.stderr)
+    index.logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    configs = index.load_subscription_configs({
+        'LOG_GROUP_MATCHES': args.log_group_matches,
+        'LOG_GROUP_EXCLUDES': args.log_group_excludes,
+        'LOG_GROUP_TAG_SELECTORS': args.log_group_tag_selectors,
+        'DESTINATION_ARN': args.destination_arn,
+        'DESTINATION_ARN_POOL': args.destination_arn_pool,
+        'DELIVERY_STREAM_ROLE_ARN': args.role_arn,
+        'FILTER_NAME': args.filter_name,
+        'FILTER_PATTERN': args.filter_pattern,
+        'ADDITIONAL_SUBSCRIPTIONS': args.additional_subscriptions,
+    })
+
+    # Each worker holds a connection, and adaptive retries back off when CloudWatch Logs throttles.
+    config = botocore.config.Config(
+        max_pool_connections=args.concurrency,
+        retries={'mode': 'adaptive', 'max_attempts': 10})
+    client_wrapper = index.AWSWrapper(
+        boto3.client('logs', config=config), boto3.client('events'), None)
+
+    journal = None
+    if args.state_table != '':
+        journal = index.ProgressJournal(index.DynamoDBCheckpointStore(
+            boto3.client('dynamodb'), args.state_table), configs)
+
+    ok = run(client_wrapper, args.action == 'create', configs,
+             args.start_log_group, args.concurrency, journal, sys.stdout)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
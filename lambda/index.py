@@ -1,5 +1,10 @@
+import bisect
+import collections
+import concurrent.futures
 import dataclasses
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import os
@@ -27,6 +32,82 @@ EVENTBRIDGE_DETAIL_TYPE = "pagination"
 # lambda timeouts.
 MAX_SUBSCRIPTIONS_PER_INVOCATION = 100
 
+# CloudWatch Logs allows at most MAX_SUBSCRIPTION_FILTERS_PER_LOG_GROUP subscription
+# filters per log group. When several subscription configurations compete for the
+# remaining slots, configurations earlier in the list win.
+MAX_SUBSCRIPTION_FILTERS_PER_LOG_GROUP = 2
+
+# The progress journal is saved every JOURNAL_FLUSH_INTERVAL completed log groups, and at
+# the end of each invocation, JOURNAL_CHUNK_SIZE ranges at a time so that no document comes
+# close to DynamoDB's 400 KB item limit. Journals expire after JOURNAL_TTL_SECONDS, so that an
+# abandoned run doesn't cause log groups to be skipped indefinitely.
+JOURNAL_FLUSH_INTERVAL = 20
+JOURNAL_CHUNK_SIZE = 100
+JOURNAL_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# EventBridge delivers CreateLogGroup events at least once. A log group handled within the
+# last DEDUP_TTL_SECONDS is not handled again. At most DEDUP_MAX_ENTRIES log groups are
+# remembered by each execution environment.
+DEDUP_TTL_SECONDS = 10 * 60
+DEDUP_MAX_ENTRIES = 10000
+
+# The subscription filters of a log group, as described or written by an execution environment,
+# are reused for SUBSCRIPTION_STATE_TTL_SECONDS instead of being described again. The filters of
+# at most SUBSCRIPTION_STATE_MAX_ENTRIES log groups are kept. CloudFormation and scheduled events
+# forget them first, since other execution environments may have changed them. CreateLogGroup
+# events only forget filters that were cached less than SUBSCRIPTION_STATE_CLOCK_SKEW_SECONDS
+# after the log group was created, since CloudTrail event times are rounded down to the second.
+SUBSCRIPTION_STATE_TTL_SECONDS = 5 * 60
+SUBSCRIPTION_STATE_MAX_ENTRIES = 10000
+SUBSCRIPTION_STATE_CLOCK_SKEW_SECONDS = 5
+
+# Log groups that fail with one of RETRYABLE_ERROR_CODES are retried once at the end of the
+# invocation, after RETRY_DELAY_SECONDS. If they still fail, they are carried forward to the next
+# pagination event, or reported as failed if there is none. At most MAX_CARRIED_RETRIES log groups
+# are carried forward, so that pagination events stay well below EventBridge's 256 KB entry limit,
+# and the rest are reported as failed. At most MAX_REPORTED_FAILURES log group names, taking up at
+# most MAX_REPORTED_FAILURES_BYTES, are reported to CloudFormation, whose responses are limited to 4 KB.
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException',
+    'ServiceUnavailableException',
+    'OperationAbortedException',
+    'InternalFailure',
+    'RequestTimeout',
+    'EndpointConnectionError',
+    'ConnectTimeoutError',
+    'ReadTimeoutError',
+}
+RETRY_DELAY_SECONDS = 1
+MAX_REPORTED_FAILURES = 20
+MAX_REPORTED_FAILURES_BYTES = 1024
+MAX_CARRIED_RETRIES = 100
+
+# Log groups of these classes do not support subscription filters. They are skipped without
+# any API call, and counted separately from failures.
+INELIGIBLE_LOG_GROUP_CLASSES = {'INFREQUENT_ACCESS', 'DELIVERY'}
+
+# If dormant log groups are deferred, a log group is dormant if it has no stored bytes and is
+# older than DORMANT_GRACE_SECONDS, since storedBytes is only updated periodically. The names of
+# deferred log groups are saved DEFERRED_CHUNK_SIZE at a time, and expire after
+# DEFERRED_TTL_SECONDS unless a scheduled pass saves them again.
+DORMANT_GRACE_SECONDS = 24 * 60 * 60
+DEFERRED_CHUNK_SIZE = 1000
+DEFERRED_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Log group tags are only fetched for log groups that pass name filtering and are selected by
+# a config with tag selectors. Tags are fetched TAG_PREFETCH_BATCH log groups at a time, with
+# at most TAG_FETCH_CONCURRENCY concurrent requests and TAG_FETCH_RATE requests per second,
+# and cached by each execution environment for TAG_CACHE_TTL_SECONDS.
+TAG_PREFETCH_BATCH = 50
+TAG_FETCH_CONCURRENCY = 8
+TAG_FETCH_RATE = 20
+TAG_CACHE_TTL_SECONDS = 15 * 60
+
+# Log groups are assigned to the members of a destination pool with a consistent hash ring on
+# which each member has DESTINATION_VIRTUAL_NODES points. More points spread log groups more
+# evenly, at the cost of a larger ring.
+DESTINATION_VIRTUAL_NODES = 100
+
 # If our code generates an exception on rollback (delete), the user will need to go to the UI
 # to manually delete the CloudFormation Stack. IGNORE_DELETE_ERRORS allows the user to
 # delete the stack without going to the UI.
@@ -39,6 +120,167 @@ class SubscriptionArgs:
     filter_name: str
     filter_pattern: str
     role_arn: str
+    # If destination_pool is not empty, each log group is sent to the member chosen for it by
+    # destination_ring, and destination_arn is only the member chosen for one log group. It is
+    # not compared, so that growing the pool only changes the args of log groups that move.
+    destination_pool: typing.List[str] = dataclasses.field(default_factory=list, compare=False)
+
+
+@dataclasses.dataclass
+class SubscriptionConfig:
+    """SubscriptionConfig selects log groups with regex patterns and describes the
+    subscription filter to create on each selected log group."""
+    matches: typing.List[str]
+    exclusions: typing.List[str]
+    args: SubscriptionArgs
+    # If tag_selectors is not empty, selected log groups must also have a matching tag. See should_subscribe.
+    tag_selectors: typing.List[str] = dataclasses.field(default_factory=list)
+
+    def args_for(self, log_group_name: str) -> SubscriptionArgs:
+        """args_for returns the subscription args for the log group 'log_group_name', with the
+        destination assigned to it if the config has a destination pool."""
+        if not self.args.destination_pool:
+            return self.args
+        ring = destination_ring(tuple(self.args.destination_pool))
+        return dataclasses.replace(self.args, destination_arn=ring.lookup(log_group_name))
+
+
+class HashRing:
+    """HashRing assigns keys to members with consistent hashing.
+
+    Each member is hashed to DESTINATION_VIRTUAL_NODES points on a ring, and a key is assigned to
+    the member owning the first point at or after the key's hash. Adding a member only moves the
+    keys that hash next to its points, about 1/N of all keys, and removing a member only moves
+    the keys that were assigned to it.
+    """
+
+    def __init__(self, members: typing.Iterable[str], virtual_nodes: int = DESTINATION_VIRTUAL_NODES) -> None:
+        points = sorted((self.hash(f'{m}#{i}'), m)
+                        for m in set(members) for i in range(virtual_nodes))
+        if not points:
+            raise ValueError('a hash ring needs at least one member')
+        self.hashes = [h for h, _ in points]
+        self.members = [m for _, m in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        # hash() is salted per process, so assignments would not be stable across invocations.
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big')
+
+    def lookup(self, key: str) -> str:
+        i = bisect.bisect_left(self.hashes, self.hash(key))
+        return self.members[i % len(self.members)]
+
+
+@functools.lru_cache(maxsize=16)
+def destination_ring(pool: typing.Tuple[str, ...]) -> HashRing:
+    """destination_ring returns the hash ring of a destination pool, built once per execution environment"""
+    return HashRing(pool)
+
+
+def parse_subscription_configs(value: str) -> typing.List[SubscriptionConfig]:
+    """parse_subscription_configs parses a JSON list of subscription configurations,
+    as written to the ADDITIONAL_SUBSCRIPTIONS environment variable by main.tf.
+
+    A configuration may set destination_arn_pool to a list of destination ARNs among which log
+    groups are spread, in which case destination_arn is ignored."""
+    if value == "":
+        return []
+    configs = []
+    for c in json.loads(value):
+        configs.append(SubscriptionConfig(
+            matches=c.get('log_group_matches', []),
+            exclusions=c.get('log_group_excludes', []),
+            args=SubscriptionArgs(
+                c['destination_arn'],
+                c['filter_name'],
+                c.get('filter_pattern', ''),
+                c['role_arn'],
+                c.get('destination_arn_pool', [])),
+            tag_selectors=c.get('log_group_tag_selectors', [])))
+    return configs
+
+
+def load_subscription_configs(values: typing.Mapping[str, str]) -> typing.List[SubscriptionConfig]:
+    """load_subscription_configs returns the primary subscription config followed by any additional
+    configs. values uses the environment variable names documented in main, and may be os.environ
+    or the Configuration property of the CloudFormation custom resource."""
+    matchStr = values['LOG_GROUP_MATCHES']
+    exclusionStr = values['LOG_GROUP_EXCLUDES']
+    tagSelectorStr = values.get('LOG_GROUP_TAG_SELECTORS', '')
+    poolStr = values.get('DESTINATION_ARN_POOL', '')
+    args = SubscriptionArgs(values['DESTINATION_ARN'], values['FILTER_NAME'],
+                            values['FILTER_PATTERN'], values['DELIVERY_STREAM_ROLE_ARN'],
+                            poolStr.split(',') if poolStr != "" else [])
+    primary = SubscriptionConfig(
+        matchStr.split(',') if matchStr != "" else [],
+        exclusionStr.split(',') if exclusionStr != "" else [],
+        args,
+        tagSelectorStr.split(',') if tagSelectorStr != "" else [])
+    return [primary] + parse_subscription_configs(values.get('ADDITIONAL_SUBSCRIPTIONS', ''))
+
+
+class SubscriptionStateCache:
+    """SubscriptionStateCache remembers the subscription filters of recently described log groups.
+
+    Entries expire after ttl_seconds. At most max_entries are kept, evicting the least recently
+    used entry first. put_filter and delete_filter apply our own writes to cached entries, so that
+    they stay correct without describing the log group again.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> typing.Optional[typing.List[dict]]:
+        """get returns a copy of the cached filters of the log group 'name', or None"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[1] <= time.time():
+                del self.entries[name]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return [dict(f) for f in entry[0]]
+
+    def put(self, name: str, filters: typing.List[dict]) -> None:
+        with self.lock:
+            self.entries[name] = ([dict(f) for f in filters], time.time() + self.ttl_seconds)
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put_filter(self, name: str, f: dict) -> None:
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry[0][:] = [e for e in entry[0] if e['filterName'] != f['filterName']] + [dict(f)]
+
+    def delete_filter(self, name: str, filter_name: str) -> None:
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry[0][:] = [e for e in entry[0] if e['filterName'] != filter_name]
+
+    def invalidate(self, name: typing.Optional[str] = None, before: typing.Optional[float] = None) -> None:
+        """invalidate forgets the filters of the log group 'name', or of all log groups if it is None.
+        If before is not None, filters cached at or after that time are kept."""
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+            elif before is None:
+                self.entries.pop(name, None)
+            else:
+                entry = self.entries.get(name)
+                if entry is not None and entry[1] - self.ttl_seconds < before:
+                    del self.entries[name]
 
 
 class AWSWrapper:
@@ -49,25 +291,64 @@ class AWSWrapper:
 
     The code for this class should be simple since it is not easy to test the
     wrapper implementation itself.
+
+    If state_cache is not None, described subscription filters are cached in it, and
+    our own puts and deletes are written through to it. A failed put or delete
+    invalidates the log group's entry, since its state is then unknown.
     """
     pass
 
-    def __init__(self, logs_client, events_client, context) -> None:
+    def __init__(self, logs_client, events_client, context,
+                 state_cache: typing.Optional[SubscriptionStateCache] = None) -> None:
         self.logs_client = logs_client
         self.events_client = events_client
         self.context = context
+        self.state_cache = state_cache
 
     def describe_log_groups_paginator(self):
         return self.logs_client.get_paginator('describe_log_groups')
 
     def describe_subscription_filters(self, **kwargs):
-        return self.logs_client.describe_subscription_filters(**kwargs)
+        if self.state_cache is None:
+            return self.logs_client.describe_subscription_filters(**kwargs)
+        filters = self.state_cache.get(kwargs['logGroupName'])
+        if filters is not None:
+            return {'subscriptionFilters': filters}
+        resp = self.logs_client.describe_subscription_filters(**kwargs)
+        self.state_cache.put(kwargs['logGroupName'], resp['subscriptionFilters'])
+        return resp
 
     def put_subscription_filter(self, **kwargs):
-        return self.logs_client.put_subscription_filter(**kwargs)
+        try:
+            resp = self.logs_client.put_subscription_filter(**kwargs)
+        except Exception:
+            self.forget_subscription_state(kwargs['logGroupName'])
+            raise
+        if self.state_cache is not None:
+            self.state_cache.put_filter(kwargs['logGroupName'], {
+                k: v for k, v in kwargs.items() if k != 'logGroupName'})
+        return resp
 
     def delete_subscription_filter(self, **kwargs):
-        return self.logs_client.delete_subscription_filter(**kwargs)
+        try:
+            resp = self.logs_client.delete_subscription_filter(**kwargs)
+        except Exception:
+            self.forget_subscription_state(kwargs['logGroupName'])
+            raise
+        if self.state_cache is not None:
+            self.state_cache.delete_filter(kwargs['logGroupName'], kwargs['filterName'])
+        return resp
+
+    def forget_subscription_state(self, log_group_name: typing.Optional[str] = None,
+                                  changed_at: typing.Optional[float] = None) -> None:
+        """forget_subscription_state makes the next describe of the log group, or of all log groups
+        if log_group_name is None, call AWS, e.g. because its filters were changed by someone else.
+        If changed_at, a Unix time, is not None, state cached since then is kept."""
+        if self.state_cache is not None:
+            self.state_cache.invalidate(log_group_name, changed_at)
+
+    def list_tags_for_resource(self, **kwargs):
+        return self.logs_client.list_tags_for_resource(**kwargs)
 
     def put_events(self, **kwargs):
         return self.events_client.put_events(**kwargs)
@@ -92,47 +373,601 @@ class AWSWrapper:
             reason=reason)
 
 
+def config_fingerprint(configs: typing.List[SubscriptionConfig]) -> str:
+    """config_fingerprint returns a stable hash of configs. Work recorded under one fingerprint is
+    not valid for configs with a different fingerprint.
+
+    The destination_arn of a config with a destination pool is left out, and its pool is sorted,
+    since neither changes the destination assigned to any log group."""
+    def fingerprinted(c: SubscriptionConfig) -> dict:
+        d = dataclasses.asdict(c)
+        if c.args.destination_pool:
+            del d['args']['destination_arn']
+            d['args']['destination_pool'] = sorted(set(c.args.destination_pool))
+        return d
+    encoded = json.dumps([fingerprinted(c)
+                         for c in configs], sort_keys=True)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class LocalCheckpointStore:
+    """LocalCheckpointStore persists small JSON documents by key.
+
+    LocalCheckpointStore keeps documents in memory, so they only survive for the lifetime of
+    a warm Lambda execution environment. It is the local stand-in for DynamoDBCheckpointStore.
+    """
+
+    def __init__(self) -> None:
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def load(self, key: str) -> typing.Optional[dict]:
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                del self.items[key]
+                return None
+            return json.loads(value)
+
+    def save(self, key: str, value: dict, ttl_seconds: int) -> None:
+        with self.lock:
+            self.items[key] = (json.dumps(value), time.time() + ttl_seconds)
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class DynamoDBCheckpointStore:
+    """DynamoDBCheckpointStore persists documents in the DynamoDB table created by
+    main.tf when enable_state_table is set.
+
+    Expired items are filtered on read, since DynamoDB TTL deletion is best-effort.
+    """
+
+    def __init__(self, dynamodb_client, table_name: str) -> None:
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+
+    def load(self, key: str) -> typing.Optional[dict]:
+        resp = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'key': {'S': key}},
+            ConsistentRead=True)
+        item = resp.get('Item')
+        if item is None or int(item['expires_at']['N']) <= time.time():
+            return None
+        return json.loads(item['value']['S'])
+
+    def save(self, key: str, value: dict, ttl_seconds: int) -> None:
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                'key': {'S': key},
+                'value': {'S': json.dumps(value)},
+                'expires_at': {'N': str(int(time.time() + ttl_seconds))},
+            })
+
+    def delete(self, key: str) -> None:
+        self.dynamodb_client.delete_item(
+            TableName=self.table_name,
+            Key={'key': {'S': key}})
+
+
+CheckpointStore = typing.Union[LocalCheckpointStore, DynamoDBCheckpointStore]
+
+# subscription_state_cache is shared by all invocations handled by a warm execution environment.
+subscription_state_cache = SubscriptionStateCache(
+    SUBSCRIPTION_STATE_TTL_SECONDS, SUBSCRIPTION_STATE_MAX_ENTRIES)
+
+# local_checkpoint_store is shared by all invocations handled by a warm execution environment.
+local_checkpoint_store = LocalCheckpointStore()
+
+
+class ProgressJournal:
+    """ProgressJournal records the ranges of log group names for which a Create or Delete has
+    finished, so that a retried or re-applied run can skip them.
+
+    The journal is saved in chunks keyed by the fingerprint of the subscription configs. Ranges are
+    only appended, or extended at the end, so a flush only saves the chunks that changed. A journal
+    with a missing chunk is treated as empty. Each range records the request type that completed
+    it and a sequence number. A log group is done
+    for a request type if the most recent range containing its name was completed by that request
+    type, so a partial Delete invalidates the Create ranges it overlaps and vice versa.
+
+    Ranges are inclusive, and only cover log groups that existed when they were recorded. Log groups
+    created later are subscribed by the CreateLogGroup event rule.
+    """
+
+    def __init__(self, store: CheckpointStore,
+                 configs: typing.List[SubscriptionConfig]) -> None:
+        self.store = store
+        self.key = 'journal:' + config_fingerprint(configs)
+        self.ranges, self.next_seq = self._load()
+        # dirty_from is the index of the first range changed since the journal was last saved.
+        self.dirty_from = len(self.ranges)
+        self.open_range = None
+        self.pending = 0
+
+    def _load(self) -> typing.Tuple[typing.List[list], int]:
+        doc = self.store.load(self.key)
+        if doc is None:
+            return [], 0
+        ranges = []
+        for i in range(doc['chunks']):
+            chunk = self.store.load(f'{self.key}:{i}')
+            if chunk is None:
+                return [], doc['next_seq']
+            ranges.extend(chunk['ranges'])
+        return ranges, doc['next_seq']
+
+    def is_done(self, name: str, is_create: bool) -> bool:
+        latest = None
+        for r in self.ranges:
+            if r[0] <= name <= r[1] and (latest is None or r[3] > latest[3]):
+                latest = r
+        return latest is not None and latest[2] == is_create
+
+    def mark_done(self, name: str, is_create: bool) -> None:
+        """mark_done extends the open range with name, which must not sort before any name
+        previously passed to mark_done. The open range is created if there isn't one."""
+        if self.open_range is None or self.open_range[2] != is_create:
+            self.open_range = [name, name, is_create, self.next_seq]
+            self.next_seq += 1
+            self.ranges.append(self.open_range)
+        self.open_range[1] = name
+        self.dirty_from = min(self.dirty_from, len(self.ranges) - 1)
+        self.pending += 1
+        if self.pending >= JOURNAL_FLUSH_INTERVAL:
+            self.flush()
+
+    def resume_from(self, name: str, is_create: bool) -> None:
+        """resume_from continues the most recent range if it ends with name, so that
+        consecutive invocations of a run share a single range."""
+        if self.ranges and self.ranges[-1][1] == name and self.ranges[-1][2] == is_create:
+            self.open_range = self.ranges[-1]
+
+    def break_range(self) -> None:
+        """break_range closes the open range, e.g. because a log group could not be modified."""
+        self.open_range = None
+
+    def flush(self) -> None:
+        if self.pending == 0:
+            return
+        try:
+            chunks = (len(self.ranges) + JOURNAL_CHUNK_SIZE - 1) // JOURNAL_CHUNK_SIZE
+            for i in range(self.dirty_from // JOURNAL_CHUNK_SIZE, chunks):
+                self.store.save(f'{self.key}:{i}', {
+                    'ranges': self.ranges[i * JOURNAL_CHUNK_SIZE:(i + 1) * JOURNAL_CHUNK_SIZE],
+                }, JOURNAL_TTL_SECONDS)
+            self.store.save(self.key, {
+                'chunks': chunks,
+                'next_seq': self.next_seq,
+            }, JOURNAL_TTL_SECONDS)
+            self.pending = 0
+            self.dirty_from = len(self.ranges)
+        except Exception as err:
+            logger.error('error saving progress journal %s: %s', self.key, err)
+
+    def clear(self) -> None:
+        self.ranges, self.open_range, self.pending, self.dirty_from = [], None, 0, 0
+        try:
+            doc = self.store.load(self.key)
+            if doc is not None:
+                self.store.delete(self.key)
+                for i in range(doc['chunks']):
+                    self.store.delete(f'{self.key}:{i}')
+        except Exception as err:
+            logger.error('error clearing progress journal %s: %s', self.key, err)
+
+
+class DeferredLogGroups:
+    """DeferredLogGroups records the dormant log groups whose subscription was deferred.
+
+    The names are saved in chunks keyed by the fingerprint of the subscription configs, so that a
+    single document never grows too large. next_log_group is where the scan of all log groups that
+    finds dormant log groups should continue, or None once every log group has been scanned.
+    """
+
+    def __init__(self, store: CheckpointStore,
+                 configs: typing.List[SubscriptionConfig]) -> None:
+        self.store = store
+        self.key = 'deferred:' + config_fingerprint(configs)
+
+    def load(self) -> typing.Optional[typing.Tuple[typing.Set[str], typing.Optional[str]]]:
+        """load returns the deferred log groups and next_log_group, or None if nothing is known
+        about them, in which case every log group needs to be scanned."""
+        doc = self.store.load(self.key)
+        if doc is None:
+            return None
+        names = set()
+        for i in range(doc['chunks']):
+            chunk = self.store.load(f'{self.key}:{i}')
+            if chunk is None:
+                return None
+            names.update(chunk['names'])
+        return names, doc['next']
+
+    def save(self, names: typing.Set[str], next_log_group: typing.Optional[str]) -> None:
+        doc = self.store.load(self.key)
+        ordered = sorted(names)
+        chunks = [ordered[i:i + DEFERRED_CHUNK_SIZE]
+                  for i in range(0, len(ordered), DEFERRED_CHUNK_SIZE)]
+        for i, chunk in enumerate(chunks):
+            self.store.save(f'{self.key}:{i}', {'names': chunk}, DEFERRED_TTL_SECONDS)
+        self.store.save(self.key, {'chunks': len(chunks), 'next': next_log_group},
+                        DEFERRED_TTL_SECONDS)
+        for i in range(len(chunks), doc['chunks'] if doc is not None else 0):
+            self.store.delete(f'{self.key}:{i}')
+
+    def clear(self) -> None:
+        doc = self.store.load(self.key)
+        if doc is None:
+            return
+        self.store.delete(self.key)
+        for i in range(doc['chunks']):
+            self.store.delete(f'{self.key}:{i}')
+
+
+class DedupCache:
+    """DedupCache remembers recently handled keys, such as the log groups of CreateLogGroup events,
+    so that duplicate deliveries can be dropped before any AWS API call is made.
+
+    Entries expire after ttl_seconds. At most max_entries are kept in memory, evicting the least
+    recently added entry first. If shared_store is not None, entries are also saved to it, so that
+    duplicates delivered to other execution environments are dropped as well.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int,
+                 shared_store: typing.Optional[CheckpointStore] = None) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.shared_store = shared_store
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def contains(self, key: str) -> bool:
+        """contains returns True if key was added within the last ttl_seconds, and counts a hit or miss"""
+        now = time.time()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            found = expires_at is not None and expires_at > now
+            if expires_at is not None and not found:
+                del self.entries[key]
+        if not found and self.shared_store is not None:
+            try:
+                found = self.shared_store.load('dedup:' + key) is not None
+            except Exception as err:
+                logger.error('error reading dedup entry %s: %s', key, err)
+            if found:
+                self._add_local(key, now)
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def add(self, key: str) -> None:
+        self._add_local(key, time.time())
+        if self.shared_store is not None:
+            try:
+                self.shared_store.save('dedup:' + key, {}, self.ttl_seconds)
+            except Exception as err:
+                logger.error('error saving dedup entry %s: %s', key, err)
+
+    def _add_local(self, key: str, now: float) -> None:
+        with self.lock:
+            self.entries[key] = now + self.ttl_seconds
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return self.hits / lookups if lookups > 0 else 0.0
+
+
+# new_log_group_dedup_cache is shared by all invocations handled by a warm execution environment.
+new_log_group_dedup_cache = DedupCache(DEDUP_TTL_SECONDS, DEDUP_MAX_ENTRIES)
+
+
+def error_code(err: Exception) -> str:
+    """error_code returns the AWS error code of err, or its class name if it has none"""
+    response = getattr(err, 'response', None)
+    if isinstance(response, dict) and 'Code' in response.get('Error', {}):
+        return response['Error']['Code']
+    return type(err).__name__
+
+
+class FailureTracker:
+    """FailureTracker records the log groups that could not be modified, and why.
+
+    Failures with an error code in RETRYABLE_ERROR_CODES are retryable. A summary of the
+    failures that will not be retried is kept separately, so that it can be carried across
+    pagination events and reported to CloudFormation once the run finishes.
+
+    Log groups that were skipped because they can never have a subscription filter are counted
+    in the summary too, but separately from failures, as are dormant log groups whose subscription
+    was deferred. The names of the latter are kept in deferred until they are saved.
+    """
+
+    def __init__(self, summary: typing.Optional[dict] = None) -> None:
+        self.pending = {}
+        self.deferred = []
+        self.summary = summary or {'count': 0, 'errors': {}, 'log_groups': []}
+        self.summary.setdefault('ineligible', {})
+        self.summary.setdefault('deferred', 0)
+        self.lock = threading.Lock()
+
+    def defer(self, log_group_name: str) -> None:
+        logger.info('deferring dormant log group %s', log_group_name)
+        with self.lock:
+            self.deferred.append(log_group_name)
+            self.summary['deferred'] += 1
+
+    def skip_ineligible(self, log_group_name: str, reason: str) -> None:
+        logger.info('skipping ineligible log group %s: %s',
+                    log_group_name, reason)
+        with self.lock:
+            self.summary['ineligible'][reason] = self.summary['ineligible'].get(
+                reason, 0) + 1
+
+    def reportable(self) -> bool:
+        """reportable checks whether the summary has anything to report"""
+        return (self.summary['count'] > 0 or len(self.summary['ineligible']) > 0
+                or self.summary['deferred'] > 0)
+
+    def record(self, log_group_name: str, code: str) -> None:
+        logger.info('recording failure for log group %s: %s',
+                    log_group_name, code)
+        with self.lock:
+            self.pending[log_group_name] = code
+
+    def resolve(self, log_group_name: str) -> None:
+        with self.lock:
+            self.pending.pop(log_group_name, None)
+
+    def retryable(self) -> typing.List[str]:
+        with self.lock:
+            return sorted(name for name, code in self.pending.items()
+                          if code in RETRYABLE_ERROR_CODES)
+
+    def give_up(self, retryable: bool = True) -> None:
+        """give_up moves pending failures into the summary. Retryable failures are
+        only moved if retryable is True."""
+        for name, code in sorted(self.pending.items()):
+            if (not retryable) and code in RETRYABLE_ERROR_CODES:
+                continue
+            self._give_up_one(name, code)
+
+    def carry_forward(self, limit: int = MAX_CARRIED_RETRIES) -> typing.List[str]:
+        """carry_forward returns at most limit retryable failures to retry in the next invocation,
+        and moves the rest into the summary."""
+        retry = self.retryable()
+        for name in retry[limit:]:
+            self._give_up_one(name, self.pending[name])
+        return retry[:limit]
+
+    def _give_up_one(self, name: str, code: str) -> None:
+        self.summary['count'] += 1
+        self.summary['errors'][code] = self.summary['errors'].get(
+            code, 0) + 1
+        if len(self.summary['log_groups']) < MAX_REPORTED_FAILURES:
+            self.summary['log_groups'].append(name)
+        del self.pending[name]
+
+    def response_data(self) -> dict:
+        """response_data describes the summarised failures for a CloudFormation response"""
+        data = {}
+        if self.summary['count'] > 0:
+            data.update({
+                'FailedLogGroupCount': self.summary['count'],
+                'FailedLogGroupErrors': json.dumps(self.summary['errors'], sort_keys=True),
+                'FailedLogGroups': self._reported_log_groups(),
+            })
+        if self.summary['ineligible']:
+            data.update({
+                'IneligibleLogGroupCount': sum(self.summary['ineligible'].values()),
+                'IneligibleLogGroupReasons': json.dumps(self.summary['ineligible'], sort_keys=True),
+            })
+        if self.summary['deferred'] > 0:
+            data['DeferredLogGroupCount'] = self.summary['deferred']
+        return data
+
+    def _reported_log_groups(self) -> str:
+        reported = ''
+        for name in self.summary['log_groups']:
+            joined = reported + ',' + name if reported else name
+            if len(joined.encode()) > MAX_REPORTED_FAILURES_BYTES:
+                break
+            reported = joined
+        return reported
+
+
+def put_subscription(
+        client_wrapper: AWSWrapper,
+        log_group_name: str,
+        subscription_args: SubscriptionArgs,
+        found_filters: typing.List[dict],
+        failures: typing.Optional[FailureTracker] = None) -> bool:
+    """put_subscription creates the subscription filter subscription_args, or replaces the filter with
+    the same name in place. found_filters is updated to match.
+
+    put_subscription returns False, and records the error in failures if it is not None, if the
+    filter could not be put.
+    """
+    try:
+        client_wrapper.put_subscription_filter(
+            logGroupName=log_group_name,
+            destinationArn=subscription_args.destination_arn,
+            filterName=subscription_args.filter_name,
+            filterPattern=subscription_args.filter_pattern,
+            roleArn=subscription_args.role_arn)
+        logger.info('put subscription filter %s for log group %s',
+                    subscription_args.filter_name, log_group_name)
+    except Exception as err:
+        logger.error(
+            'error adding subscription to log group %s: %s',
+            log_group_name,
+            err)
+        if failures is not None:
+            failures.record(log_group_name, error_code(err))
+        return False
+    found_filters[:] = [
+        f for f in found_filters if f['filterName'] != subscription_args.filter_name]
+    found_filters.append({
+        'filterName': subscription_args.filter_name,
+        'filterPattern': subscription_args.filter_pattern,
+        'destinationArn': subscription_args.destination_arn,
+        'roleArn': subscription_args.role_arn,
+    })
+    return True
+
+
+class RateLimiter:
+    """RateLimiter blocks callers of wait so that at most rate calls proceed per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TagIndex:
+    """TagIndex caches the tags of log groups by name.
+
+    Tags are fetched with ListTagsForResource, at most TAG_FETCH_CONCURRENCY at a time and
+    TAG_FETCH_RATE per second. Entries expire after ttl_seconds.
+    """
+
+    def __init__(self, ttl_seconds: int = TAG_CACHE_TTL_SECONDS) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.rate_limiter = RateLimiter(TAG_FETCH_RATE)
+
+    def lookup(self, name: str) -> typing.Optional[typing.Dict[str, str]]:
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[1] <= time.time():
+                return None
+            return entry[0]
+
+    def put(self, name: str, tags: typing.Dict[str, str]) -> None:
+        with self.lock:
+            self.entries[name] = (tags, time.time() + self.ttl_seconds)
+
+    def fetch(self, client_wrapper: AWSWrapper,
+              log_groups: typing.List[dict]) -> typing.Dict[str, str]:
+        """fetch fetches and caches the tags of log_groups, as returned by DescribeLogGroups.
+
+        fetch returns the error code for each log group whose tags could not be fetched.
+        """
+        def fetch_one(lg: dict) -> None:
+            self.rate_limiter.wait()
+            arn = lg.get('logGroupArn') or lg['arn'].removesuffix(':*')
+            resp = client_wrapper.list_tags_for_resource(resourceArn=arn)
+            self.put(lg['logGroupName'], resp.get('tags', {}))
+
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=TAG_FETCH_CONCURRENCY) as executor:
+            futures = {executor.submit(fetch_one, lg): lg['logGroupName']
+                       for lg in log_groups}
+            for future in concurrent.futures.as_completed(futures):
+                err = future.exception()
+                if err is not None:
+                    logger.error('error listing tags of log group %s: %s',
+                                 futures[future], err)
+                    errors[futures[future]] = error_code(err)
+        logger.info('fetched tags of %d log groups, %d failed',
+                    len(log_groups), len(errors))
+        return errors
+
+
+# log_group_tag_index is shared by all invocations handled by a warm execution environment.
+log_group_tag_index = TagIndex()
+
+
 def modify_subscription(
         client_wrapper: AWSWrapper,
         is_create: bool,
         log_group_name: str,
-        subscription_args: SubscriptionArgs) -> bool:
+        subscription_args: SubscriptionArgs,
+        found_filters: typing.Optional[typing.List[dict]] = None,
+        failures: typing.Optional[FailureTracker] = None,
+        force: bool = False) -> bool:
     """modify_subscription creates or deletes a subscription filter for the log group specified by log_group_name
 
     if is_create is True, modify_subscription returns True if a subscription filter with the specified subscription_args exists (was created or already existed).
     if is_create is False, modify_subscription returns True if a subscription filter with the specified subscription_args does not exist (was deleted or did not exist).
+
+    found_filters is the list of subscription filters the log group currently has. If it is None, the
+    filters are described. Otherwise, found_filters is updated in place to reflect any changes made, so
+    that it can be shared by several calls for the same log group.
+
+    If force is True, is_create must be True, and a filter with the name in subscription_args is put
+    again even if it already exists, so that it gets the current arguments.
     """
     logger.info('modify_subscription: %s %s %s',
                 is_create, log_group_name, subscription_args)
 
-    found_filters = client_wrapper.describe_subscription_filters(
-        logGroupName=log_group_name)
-    logger.info('log group %s has filters %s', log_group_name, found_filters)
+    if found_filters is None:
+        found_filters = client_wrapper.describe_subscription_filters(
+            logGroupName=log_group_name)['subscriptionFilters']
+        logger.info('log group %s has filters %s',
+                    log_group_name, found_filters)
 
     filter_exists = False
-    for f in found_filters['subscriptionFilters']:
+    drifted = False
+    for f in found_filters:
         # TODO(luke): this doesn't ensure that subscription filters that weren't cleaned up properly get
         # the new arguments.
-        if is_create and f['destinationArn'] == subscription_args.destination_arn:
+        is_ours = f['filterName'] == subscription_args.filter_name
+        if is_create and f['destinationArn'] == subscription_args.destination_arn and not (force and is_ours):
             return True  # A subscription to this destination ARN already exists
-        if f['filterName'] == subscription_args.filter_name:
+        if is_ours:
             filter_exists = True
+            drifted = f['destinationArn'] in subscription_args.destination_pool
+
+    if is_create and force and filter_exists:
+        return put_subscription(client_wrapper, log_group_name, subscription_args, found_filters, failures)
+
+    if is_create and drifted:
+        # The filter sends to another member of the destination pool, for example because the pool
+        # grew. Replacing it in place moves the log group without needing a free slot. Any other
+        # cached state of the log group may be out of date too.
+        client_wrapper.forget_subscription_state(log_group_name)
+        logger.info('moving subscription filter %s of log group %s to %s',
+                    subscription_args.filter_name, log_group_name, subscription_args.destination_arn)
+        return put_subscription(client_wrapper, log_group_name, subscription_args, found_filters, failures)
 
     if is_create and (not filter_exists):
-        try:
-            client_wrapper.put_subscription_filter(
-                logGroupName=log_group_name,
-                destinationArn=subscription_args.destination_arn,
-                filterName=subscription_args.filter_name,
-                filterPattern=subscription_args.filter_pattern,
-                roleArn=subscription_args.role_arn)
-            logger.info('created subscription filter %s for log group %s',
-                        subscription_args.filter_name, log_group_name)
-        except Exception as err:
+        if len(found_filters) >= MAX_SUBSCRIPTION_FILTERS_PER_LOG_GROUP:
             logger.error(
-                'error adding subscription to log group %s: %s',
+                'cannot add subscription filter %s to log group %s: all %d filter slots are in use by %s',
+                subscription_args.filter_name,
                 log_group_name,
-                err)
+                MAX_SUBSCRIPTION_FILTERS_PER_LOG_GROUP,
+                [f['filterName'] for f in found_filters])
+            if failures is not None:
+                failures.record(log_group_name, 'LimitExceededException')
+            return False
+        if not put_subscription(client_wrapper, log_group_name, subscription_args, found_filters, failures):
             return False
 
     if (not is_create) and filter_exists:
@@ -147,15 +982,158 @@ def modify_subscription(
                 'error removing subscription from log group %s: %s',
                 log_group_name,
                 err)
+            if failures is not None:
+                failures.record(log_group_name, error_code(err))
             return False
+        found_filters[:] = [
+            f for f in found_filters if f['filterName'] != subscription_args.filter_name]
     return True
 
 
+def modify_log_group_subscriptions(
+        client_wrapper: AWSWrapper,
+        is_create: bool,
+        log_group_name: str,
+        subscription_args: typing.List[SubscriptionArgs],
+        failures: typing.Optional[FailureTracker] = None,
+        force: bool = False) -> typing.List[bool]:
+    """modify_log_group_subscriptions applies every element of subscription_args to a single log group.
+
+    The log group's subscription filters are described once and shared by all elements, which are
+    applied in order. modify_log_group_subscriptions returns the result of modify_subscription for
+    each element, with force passed on.
+
+    If failures is not None, errors are recorded in it instead of being raised.
+    """
+    found_filters = describe_subscription_filters(
+        client_wrapper, log_group_name, failures)
+    if found_filters is None:
+        return [False] * len(subscription_args)
+
+    return [modify_subscription(client_wrapper, is_create, log_group_name, a, found_filters, failures, force)
+            for a in subscription_args]
+
+
+def update_log_group_subscriptions(
+        client_wrapper: AWSWrapper,
+        log_group_name: str,
+        old_args: typing.List[SubscriptionArgs],
+        new_args: typing.List[SubscriptionArgs],
+        failures: typing.Optional[FailureTracker] = None) -> typing.List[bool]:
+    """update_log_group_subscriptions moves a single log group from the subscriptions in old_args to
+    the subscriptions in new_args.
+
+    Filters in old_args whose name is not in new_args are deleted first, freeing their slots. Filters
+    whose name is in both, but whose arguments changed, are replaced in place with a single put. The
+    remaining elements of new_args are created as by modify_subscription.
+    """
+    found_filters = describe_subscription_filters(
+        client_wrapper, log_group_name, failures)
+    if found_filters is None:
+        return [False] * len(new_args)
+
+    results = []
+    old_by_name = {a.filter_name: a for a in old_args}
+    new_names = {a.filter_name for a in new_args}
+    for a in old_args:
+        if a.filter_name not in new_names:
+            results.append(modify_subscription(
+                client_wrapper, False, log_group_name, a, found_filters, failures))
+    for a in new_args:
+        old = old_by_name.get(a.filter_name)
+        exists = any(f['filterName'] == a.filter_name for f in found_filters)
+        if old is not None and old != a and exists:
+            results.append(put_subscription(
+                client_wrapper, log_group_name, a, found_filters, failures))
+        else:
+            results.append(modify_subscription(
+                client_wrapper, True, log_group_name, a, found_filters, failures))
+    return results
+
+
+def describe_subscription_filters(
+        client_wrapper: AWSWrapper,
+        log_group_name: str,
+        failures: typing.Optional[FailureTracker] = None) -> typing.Optional[typing.List[dict]]:
+    """describe_subscription_filters returns the subscription filters of a log group.
+
+    If failures is not None, errors are recorded in it and None is returned instead of raising.
+    """
+    try:
+        found_filters = client_wrapper.describe_subscription_filters(
+            logGroupName=log_group_name)['subscriptionFilters']
+    except Exception as err:
+        if failures is None:
+            raise
+        logger.error('error describing subscription filters of log group %s: %s',
+                     log_group_name, err)
+        failures.record(log_group_name, error_code(err))
+        return None
+    logger.info('log group %s has filters %s', log_group_name, found_filters)
+    return found_filters
+
+
+def ineligible_reason(log_group: dict) -> typing.Optional[str]:
+    """ineligible_reason returns why a log group can never have a subscription filter, or None if it can.
+
+    log_group is an element of DescribeLogGroups' logGroups, or the request parameters of a
+    CreateLogGroup event, so no additional API call is needed.
+    """
+    log_group_class = log_group.get('logGroupClass')
+    if log_group_class in INELIGIBLE_LOG_GROUP_CLASSES:
+        return 'logGroupClass=' + log_group_class
+    return None
+
+
+def event_time(detail: dict) -> typing.Optional[float]:
+    """event_time returns the eventTime of a CloudTrail event's detail as a Unix time, or None if
+    it has none."""
+    try:
+        return datetime.datetime.fromisoformat(detail['eventTime'].replace('Z', '+00:00')).timestamp()
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+
+def is_dormant(log_group: dict) -> bool:
+    """is_dormant checks whether a log group, an element of DescribeLogGroups' logGroups, has
+    never stored any data and is older than DORMANT_GRACE_SECONDS."""
+    if log_group.get('storedBytes') != 0 or 'creationTime' not in log_group:
+        return False
+    return log_group['creationTime'] / 1000 <= time.time() - DORMANT_GRACE_SECONDS
+
+
+def selected_subscription_args(
+        name: str,
+        configs: typing.List[SubscriptionConfig],
+        tags: typing.Optional[typing.Dict[str, str]] = None) -> typing.List[SubscriptionArgs]:
+    """selected_subscription_args returns the subscription args of every config that selects the log group 'name'"""
+    return [c.args_for(name) for c in configs
+            if should_subscribe(name, c.matches, c.exclusions, tags, c.tag_selectors)]
+
+
+def needs_tags(name: str, configs: typing.List[SubscriptionConfig]) -> bool:
+    """needs_tags checks whether the tags of the log group 'name' are needed to decide which configs select it"""
+    return any(c.tag_selectors and should_subscribe(name, c.matches, c.exclusions)
+               for c in configs)
+
+
+def tag_matches(tags: typing.Dict[str, str], selector: str) -> bool:
+    """tag_matches checks whether tags satisfy a selector of the form 'key=value', or 'key' for any value"""
+    key, sep, value = selector.partition('=')
+    return key in tags and (not sep or tags[key] == value)
+
+
 def should_subscribe(
         name: str,
         matches: typing.List[str],
-        exclusions: typing.List[str]) -> bool:
-    """should_subscribe checks whether a log group with name 'name' should be subscribed to"""
+        exclusions: typing.List[str],
+        tags: typing.Optional[typing.Dict[str, str]] = None,
+        tag_selectors: typing.Optional[typing.List[str]] = None) -> bool:
+    """should_subscribe checks whether a log group with name 'name' should be subscribed to
+
+    If tag_selectors is not empty, the log group must also have a tag, in tags, that matches any
+    selector. Tags are only consulted for log groups that pass the name patterns.
+    """
     exclude = any([re.fullmatch(pattern, name)
                    for pattern in exclusions])
     if exclude:
@@ -166,7 +1144,12 @@ def should_subscribe(
     else:
         match = any([re.fullmatch(pattern, name)
                     for pattern in matches])
-        if match:
+        if match and tag_selectors:
+            if tags is not None and any(tag_matches(tags, s) for s in tag_selectors):
+                return True
+            logging.info(
+                'no tags of log group %s match %s', name, tag_selectors)
+        elif match:
             return True
         else:
             logging.info(
@@ -175,25 +1158,72 @@ def should_subscribe(
 
 
 def modify_subscriptions(client_wrapper: AWSWrapper,
-                         is_create: str,
-                         matches: list,
-                         exclusions: list,
+                         is_create: bool,
+                         configs: typing.List[SubscriptionConfig],
                          start_log_group: typing.Optional[str],
-                         subscription_args: SubscriptionArgs) -> typing.Tuple[typing.Optional[str],
-                                                                              bool]:
+                         journal: typing.Optional[ProgressJournal] = None,
+                         failures: typing.Optional[FailureTracker] = None,
+                         retry_log_groups: typing.Optional[typing.List[str]] = None,
+                         old_configs: typing.Optional[typing.List[SubscriptionConfig]] = None,
+                         tag_index: typing.Optional[TagIndex] = None,
+                         max_log_groups: typing.Optional[int] = MAX_SUBSCRIPTIONS_PER_INVOCATION,
+                         concurrency: int = 1,
+                         progress: typing.Optional[typing.Callable[[str, bool], None]] = None,
+                         defer_dormant: bool = False,
+                         only: typing.Optional[typing.Set[str]] = None,
+                         force: bool = False) -> typing.Tuple[typing.Optional[str], bool]:
     """modify_subscriptions creates or cleans up subscription filters for log groups that satisfy the
-    lists of match and exclusion regex patterns. Exclusions have precedence over matches.
+    lists of match and exclusion regex patterns of each config. Exclusions have precedence over matches.
 
-    modify_subscriptions creates subscription filters for at most MAX_SUBSCRIPTIONS_PER_INVOCATION log groups,
-    starting with the log group specified by start_log_group.
+    The log groups are listed once, and the subscription filters of each selected log group are
+    described once, no matter how many configs select it. Configs are applied in order.
+
+    modify_subscriptions modifies subscription filters for at most max_log_groups log groups, or all of
+    them if max_log_groups is None, starting with the log group specified by start_log_group. Up to
+    concurrency log groups are modified at a time.
 
     modify_subscriptions returns the name of the next subscription to be subscribed to, if any, and
     a boolean which is False if an error should be surfaced to the user.
 
-    Subscriptions are created with subscription_args.
+    If journal is not None, log groups that the journal records as done are skipped and do not count
+    towards max_log_groups. Log groups are recorded in the journal as they complete, in name order.
+    progress, if not None, is called in the same order with the name of each modified log group and
+    whether it was modified successfully.
+
+    Failed log groups are recorded in failures. retry_log_groups, which were carried forward from a
+    previous invocation, are retried first. Log groups that failed with a retryable error are retried
+    once more before returning. Failures that are left are moved into the failure summary, except for
+    retryable ones when there is a next log group, so that they can be carried forward again.
+
+    If old_configs is not None, is_create must be True, and modify_subscriptions moves log groups from
+    old_configs to configs. Only log groups that are selected differently by the two are modified and
+    count towards max_log_groups.
+
+    Tags of log groups selected by configs with tag selectors are looked up in tag_index, and
+    fetched in batches if they are not cached. If is_create is False, tag selectors are ignored.
+
+    Selected log groups that can never have a subscription filter, according to ineligible_reason,
+    are skipped and counted in failures separately from failed log groups. If a config with tag
+    selectors selects such a log group by name, it is skipped without looking up its tags.
+
+    If defer_dormant is True, is_create must be True, and log groups that would be newly subscribed
+    but are dormant, according to is_dormant, are skipped and recorded in failures as deferred. They
+    are recorded in the journal as done, so the caller must keep them along with the journal.
+
+    If only is not None, log groups whose names are not in it are ignored.
+
+    If force is True, is_create must be True and old_configs None, and existing filters of selected
+    log groups are put again. See modify_subscription.
     """
-    logger.info('modify_subscriptions: %s %s %s %s',
-                is_create, matches, exclusions, subscription_args)
+    if failures is None:
+        failures = FailureTracker()
+    if tag_index is None:
+        tag_index = TagIndex()
+    if not is_create:
+        # Our filter name is what makes deleting safe. A log group whose tags changed after it was
+        # subscribed must be cleaned up too, so log groups are only selected by name.
+        configs = [dataclasses.replace(c, tag_selectors=[]) for c in configs]
+    logger.info('modify_subscriptions: %s %s', is_create, configs)
 
     # There are at most a few thousand log groups, so it should be ok to load
     # them all into memory.
@@ -212,22 +1242,155 @@ def modify_subscriptions(client_wrapper: AWSWrapper,
             if name >= start_log_group:
                 break
 
-    successes, total = 0, 0
-    next_log_group = None
-    for lg in log_groups[start_idx:]:
-        name = lg['logGroupName']
-        if should_subscribe(name, matches, exclusions):
-            if total >= MAX_SUBSCRIPTIONS_PER_INVOCATION:
-                next_log_group = name
+    if journal is not None and start_idx > 0:
+        journal.resume_from(log_groups[start_idx - 1]['logGroupName'], is_create)
+
+    # outcomes maps each modified log group to the result of each selected subscription.
+    outcomes = {}
+    skipped = 0
+    names = [lg['logGroupName'] for lg in log_groups]
+    all_configs = configs + (old_configs or [])
+
+    def lookup_tags(name: str) -> typing.Optional[typing.Dict[str, str]]:
+        """lookup_tags returns the tags of a log group, fetching them along with the tags of the
+        next log groups that need them if they are not cached. It returns None if the tags could
+        not be fetched."""
+        tags = tag_index.lookup(name)
+        if tags is not None:
+            return tags
+        batch = []
+        for lg in log_groups[bisect.bisect_left(names, name):]:
+            if len(batch) >= TAG_PREFETCH_BATCH:
                 break
-            ok = modify_subscription(
-                client_wrapper, is_create, name, subscription_args)
+            n = lg['logGroupName']
+            if (tag_index.lookup(n) is None and ineligible_reason(lg) is None
+                    and needs_tags(n, all_configs)):
+                batch.append(lg)
+        errors = tag_index.fetch(client_wrapper, batch)
+        if name in errors:
+            failures.record(name, errors[name])
+            return None
+        return tag_index.lookup(name)
+
+    def select(name: str) -> typing.Optional[typing.Tuple[typing.List[SubscriptionArgs],
+                                                          typing.List[SubscriptionArgs]]]:
+        """select returns the old and new subscription args of a log group. They are
+        only both non-empty if the log group needs to be modified. select returns None
+        if the log group's tags are needed but could not be fetched."""
+        failures.resolve(name)
+        tags = None
+        if needs_tags(name, all_configs):
+            tags = lookup_tags(name)
+            if tags is None:
+                return None
+        selected = selected_subscription_args(name, configs, tags)
+        if old_configs is None:
+            return [], selected
+        old_selected = selected_subscription_args(name, old_configs, tags)
+        if old_selected == selected:
+            return [], []
+        return old_selected, selected
+
+    def modify_group(name: str,
+                     old_selected: typing.List[SubscriptionArgs],
+                     selected: typing.List[SubscriptionArgs]) -> bool:
+        if old_configs is None:
+            outcomes[name] = modify_log_group_subscriptions(
+                client_wrapper, is_create, name, selected, failures, force)
+        else:
+            outcomes[name] = update_log_group_subscriptions(
+                client_wrapper, name, old_selected, selected, failures)
+        return all(outcomes[name])
+
+    existing = set(names)
+    for name in retry_log_groups or []:
+        selection = select(name) if name in existing else None
+        if selection is not None and (selection[0] or selection[1]):
+            modify_group(name, *selection)
+
+    # pending holds the visited log groups that have not been completed yet, in name order, with
+    # whether they need to be reported to progress and either their result or its future.
+    pending = collections.deque()
+    in_flight = 0
 
-            successes += 1 if ok else 0
-            total += 1
+    def complete(block: bool) -> None:
+        """complete completes pending log groups in order, until the next one is still being
+        modified. If block is True, or there are concurrency log groups being modified, it
+        waits for the next one instead."""
+        nonlocal in_flight
+        while pending:
+            name, modified, result = pending[0]
+            if isinstance(result, concurrent.futures.Future):
+                if not (block or in_flight >= concurrency or result.done()):
+                    return
+                result = result.result()
+                in_flight -= 1
+            pending.popleft()
+            if journal is not None:
+                if result:
+                    journal.mark_done(name, is_create)
+                else:
+                    journal.break_range()
+            if modified and progress is not None:
+                progress(name, result)
 
-    logger.info('succeeded updating (%d/%d) log groups matching patterns %s',
-                successes, total, matches)
+    next_log_group = None
+    submitted = len(outcomes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for lg in log_groups[start_idx:]:
+            name = lg['logGroupName']
+            if only is not None and name not in only:
+                continue
+            if journal is not None and journal.is_done(name, is_create):
+                pending.append((name, False, True))
+                skipped += 1
+            elif ineligible_reason(lg) is not None and needs_tags(name, all_configs):
+                # Decided by name alone, so that no tags are fetched for a log group that can
+                # never be subscribed to.
+                failures.skip_ineligible(name, ineligible_reason(lg))
+                pending.append((name, False, True))
+            else:
+                selection = select(name)
+                if selection is None:
+                    pending.append((name, True, False))
+                elif (selection[0] or selection[1]) and ineligible_reason(lg) is not None:
+                    failures.skip_ineligible(name, ineligible_reason(lg))
+                    pending.append((name, False, True))
+                elif defer_dormant and selection[1] and not selection[0] and is_dormant(lg):
+                    failures.defer(name)
+                    pending.append((name, False, True))
+                elif selection[0] or selection[1]:
+                    if max_log_groups is not None and submitted >= max_log_groups:
+                        next_log_group = name
+                        break
+                    submitted += 1
+                    in_flight += 1
+                    pending.append((name, True, executor.submit(
+                        modify_group, name, *selection)))
+                else:
+                    pending.append((name, False, True))
+            complete(block=False)
+        complete(block=True)
+
+    if journal is not None:
+        journal.flush()
+
+    retry = failures.retryable()
+    if retry:
+        logger.info('retrying %d log groups that failed with retryable errors', len(retry))
+        time.sleep(RETRY_DELAY_SECONDS)
+        for name in retry:
+            selection = select(name)
+            if selection is not None:
+                modify_group(name, *selection)
+
+    failures.give_up(retryable=next_log_group is None)
+
+    successes = sum(sum(results) for results in outcomes.values())
+    total = sum(len(results) for results in outcomes.values())
+    logger.info('succeeded updating (%d/%d) subscription filters on %d log groups, skipped %d log groups already done, %d failed so far: %s, ineligible so far: %s, deferred so far: %d',
+                successes, total, len(outcomes), skipped, failures.summary['count'], failures.summary['errors'],
+                failures.summary['ineligible'], failures.summary['deferred'])
 
     if total > 0 and successes == 0:
         logger.error(
@@ -236,51 +1399,189 @@ def modify_subscriptions(client_wrapper: AWSWrapper,
     return next_log_group, True
 
 
+def updated_subscription_configs(cfn_event) -> typing.Optional[typing.List[SubscriptionConfig]]:
+    """updated_subscription_configs returns the subscription configs that a CloudFormation Update
+    event is moving away from, or None if every log group should be reconciled from scratch, which
+    puts every selected subscription filter again.
+
+    This is the case if the previous properties have no Configuration, e.g. because they were
+    created by an older version of this module, or if its VERSION was bumped.
+    """
+    old_values = cfn_event.get('OldResourceProperties', {}).get('Configuration')
+    new_values = cfn_event.get('ResourceProperties', {}).get('Configuration')
+    if old_values is None or new_values is None:
+        logger.info('update has no previous configuration, reconciling all log groups')
+        return None
+    if old_values.get('VERSION') != new_values.get('VERSION'):
+        logger.info('configuration version changed from %s to %s, reconciling all log groups',
+                    old_values.get('VERSION'), new_values.get('VERSION'))
+        return None
+    return load_subscription_configs(old_values)
+
+
 def process_setup_event(
         client_wrapper: AWSWrapper,
         cfn_event,
         start_log_group: typing.Optional[str],
-        matches: typing.List[str],
-        exclusions: typing.List[str],
-        args: SubscriptionArgs):
+        configs: typing.List[SubscriptionConfig],
+        journal_store: typing.Optional[CheckpointStore] = None,
+        retry_log_groups: typing.Optional[typing.List[str]] = None,
+        failure_summary: typing.Optional[dict] = None,
+        tag_index: typing.Optional[TagIndex] = None,
+        defer_dormant: bool = False):
+    # Responses echo the physical resource ID of Update and Delete events. Responding to an Update
+    # with a new ID would make CloudFormation replace the resource, deleting every subscription
+    # filter afterwards.
     try:
         logger.info(
-            'assuming event is a CloudFormation create or delete event')
+            'assuming event is a CloudFormation create, update or delete event')
+        # Other execution environments may have changed subscription filters since they were
+        # cached here. A filter missing from out of date state would never be put or deleted.
+        client_wrapper.forget_subscription_state()
+        old_configs = None
+        if cfn_event['RequestType'] == 'Update':
+            old_configs = updated_subscription_configs(cfn_event)
+        journal = None
+        if journal_store is not None:
+            journal = ProgressJournal(
+                journal_store, (old_configs or []) + configs)
+        # A run that was retried from the start resumes from its journal, which skips the log
+        # groups that it already deferred.
+        resuming = start_log_group is not None or (journal is not None and bool(journal.ranges))
+        failures = FailureTracker(failure_summary)
+        deferred = None
+        if defer_dormant and journal_store is not None and cfn_event['RequestType'] != 'Delete':
+            deferred = DeferredLogGroups(journal_store, configs)
         if cfn_event['RequestType'] == 'Create':
             next_log_group, ok = modify_subscriptions(
-                client_wrapper, True, matches, exclusions, start_log_group, args)
+                client_wrapper, True, configs, start_log_group, journal=journal, failures=failures,
+                retry_log_groups=retry_log_groups, tag_index=tag_index,
+                defer_dormant=deferred is not None)
         elif cfn_event['RequestType'] == 'Delete':
             next_log_group, ok = modify_subscriptions(
-                client_wrapper, False, matches, exclusions, start_log_group, args)
+                client_wrapper, False, configs, start_log_group, journal=journal, failures=failures,
+                retry_log_groups=retry_log_groups, tag_index=tag_index)
+        elif cfn_event['RequestType'] == 'Update':
+            next_log_group, ok = modify_subscriptions(
+                client_wrapper, True, configs, start_log_group, journal=journal, failures=failures,
+                retry_log_groups=retry_log_groups, old_configs=old_configs, tag_index=tag_index,
+                defer_dormant=deferred is not None, force=old_configs is None)
+
+        if deferred is not None:
+            if old_configs is None:
+                # Every log group is scanned, so a new scan starts from scratch.
+                state = deferred.load() if resuming else None
+                names = state[0] if state is not None else set()
+                deferred.save(names | set(failures.deferred), next_log_group)
+            else:
+                # Only log groups that are selected differently are visited. Log groups that were
+                # deferred by the previous configuration remain deferred.
+                state = deferred.load()
+                if not resuming:
+                    previous = DeferredLogGroups(journal_store, old_configs)
+                    state = previous.load()
+                    previous.clear()
+                if state is not None:
+                    deferred.save(state[0] | set(failures.deferred), state[1])
 
         if ok:
             if next_log_group is None:
+                if journal is not None:
+                    # A finished run leaves nothing to resume. Re-applying the same
+                    # configuration should reconcile every log group again.
+                    journal.clear()
+                if journal_store is not None and cfn_event['RequestType'] == 'Delete':
+                    DeferredLogGroups(journal_store, configs).clear()
+                if failures.summary['count'] > 0:
+                    logger.error('failed to update %d log groups: %s, including %s',
+                                 failures.summary['count'], failures.summary['errors'],
+                                 failures.summary['log_groups'])
                 client_wrapper.send_cfnresponse(
-                    cfn_event, cfnresponse.SUCCESS, {})
+                    cfn_event, cfnresponse.SUCCESS, failures.response_data(),
+                    physicalResourceId=cfn_event.get('PhysicalResourceId'))
             else:
                 logging.info(
                     'sending pagination event: next_log_group=%s',
                     next_log_group)
+                detail = {
+                    'cfnEvent': cfn_event,
+                    'next': next_log_group,
+                }
+                if failures.pending:
+                    detail['retry'] = failures.carry_forward()
+                if failures.reportable():
+                    detail['failed'] = failures.summary
                 entry = {
                     'Time': datetime.datetime.now(),
                     'Source': EVENTBRIDGE_SOURCE,
                     'DetailType': EVENTBRIDGE_DETAIL_TYPE,
-                    'Detail': json.dumps({
-                        'cfnEvent': cfn_event,
-                        'next': next_log_group,
-                    }),
+                    'Detail': json.dumps(detail),
                 }
                 client_wrapper.put_events(Entries=[entry])
         else:
             data = {
                 'Data': 'Error: unable to create subscriptions for any log groups', }
+            data.update(failures.response_data())
             client_wrapper.send_cfnresponse(
-                cfn_event, cfnresponse.FAILED, data)
+                cfn_event, cfnresponse.FAILED, data,
+                physicalResourceId=cfn_event.get('PhysicalResourceId'))
     except Exception as e:
         logger.error('unexpected exception: %s', e)
         traceback.print_exc()
         client_wrapper.send_cfnresponse(cfn_event, cfnresponse.FAILED, {
-            'Error': str(e)})
+            'Error': str(e)}, physicalResourceId=cfn_event.get('PhysicalResourceId'))
+
+
+def process_scheduled_event(
+        client_wrapper: AWSWrapper,
+        configs: typing.List[SubscriptionConfig],
+        store: CheckpointStore,
+        tag_index: typing.Optional[TagIndex] = None) -> None:
+    """process_scheduled_event subscribes deferred log groups that are no longer dormant.
+
+    If the scan of all log groups for dormant ones has not finished, for example because nothing
+    was saved by the state table, it is continued instead, subscribing log groups that are active.
+    Either way, at most MAX_SUBSCRIPTIONS_PER_INVOCATION log groups are modified, and the next
+    scheduled event continues where this one stopped.
+
+    Nothing is done while the journal of a Create, or of an Update that reconciles every log group,
+    records progress, since that run saves the deferred log groups itself.
+    """
+    if ProgressJournal(store, configs).ranges:
+        logger.info('a setup run is in progress, skipping the scheduled pass')
+        return
+    client_wrapper.forget_subscription_state()
+    deferred = DeferredLogGroups(store, configs)
+    state = deferred.load()
+    failures = FailureTracker()
+    if state is None or state[1] is not None:
+        names, start_log_group = state if state is not None else (set(), None)
+        logger.info('scanning log groups for dormant ones, starting at %s', start_log_group)
+        next_log_group, _ = modify_subscriptions(
+            client_wrapper, True, configs, start_log_group, failures=failures, tag_index=tag_index,
+            defer_dormant=True)
+        deferred.save(names | set(failures.deferred), next_log_group)
+    elif state[0]:
+        names = state[0]
+        failed = set()
+
+        def progress(name: str, ok: bool) -> None:
+            if not ok:
+                failed.add(name)
+
+        logger.info('checking %d deferred log groups for activity', len(names))
+        next_log_group, _ = modify_subscriptions(
+            client_wrapper, True, configs, None, failures=failures, tag_index=tag_index,
+            progress=progress, defer_dormant=True, only=names)
+        # Deferred log groups that were deleted or are no longer selected are dropped.
+        remaining = set(failures.deferred) | failed
+        if next_log_group is not None:
+            remaining.update(n for n in names if n >= next_log_group)
+        deferred.save(remaining, None)
+    else:
+        logger.info('no deferred log groups')
+    logger.info('scheduled pass finished: %d log groups still deferred, %d failed: %s',
+                failures.summary['deferred'], failures.summary['count'], failures.summary['errors'])
 
 
 def send_cfnresponse_5s_before_timeout(
@@ -291,7 +1592,9 @@ def send_cfnresponse_5s_before_timeout(
     data = {
         'Data': 'Error: Lambda Function probably would have timed out. If the subscription process was close to completing, consider increasing the timeout.',
     }
-    client_wrapper.send_cfnresponse(cfn_event, cfnresponse.FAILED, data)
+    client_wrapper.send_cfnresponse(
+        cfn_event, cfnresponse.FAILED, data,
+        physicalResourceId=cfn_event.get('PhysicalResourceId'))
 
 
 def rest_of_main(
@@ -300,19 +1603,47 @@ def rest_of_main(
         matches: typing.List[str],
         exclusions: typing.List[str],
         args: SubscriptionArgs,
-        timeout: int):
-    """rest_of_main is supposed to be testable. It should not call client_wrapper"""
+        timeout: int,
+        additional_configs: typing.Optional[typing.List[SubscriptionConfig]] = None,
+        journal_store: typing.Optional[CheckpointStore] = None,
+        dedup_cache: typing.Optional[DedupCache] = None,
+        tag_index: typing.Optional[TagIndex] = None,
+        tag_selectors: typing.Optional[typing.List[str]] = None,
+        defer_dormant: bool = False):
+    """rest_of_main is supposed to be testable. It should not call client_wrapper
+
+    matches, exclusions, args and tag_selectors make up the primary subscription config. additional_configs
+    are applied after it, in order, from the same scan of the account's log groups.
+
+    If journal_store is not None, CloudFormation events record their progress in a ProgressJournal
+    so that a timed out run can be resumed by retrying it.
+
+    If dedup_cache is not None, CreateLogGroup events for a log group that was recently handled
+    with the same configs are dropped.
+
+    If tag_index is not None, it caches the tags of log groups across events.
+
+    If defer_dormant is True, CloudFormation events defer dormant log groups, and scheduled
+    events subscribe them once they become active. See process_scheduled_event.
+    """
+    configs = [SubscriptionConfig(
+        matches, exclusions, args, tag_selectors or [])]
+    configs.extend(additional_configs or [])
 
     is_cfn_event = 'ResponseURL' in event
     is_pagination_event = 'source' in event and event['source'] == EVENTBRIDGE_SOURCE
     is_new_log_group_event = 'source' in event and event['source'] == 'aws.logs'
+    is_scheduled_event = event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event'
     if is_cfn_event or is_pagination_event:
         if is_cfn_event:
             cfn_event = event
             start_log_group = None
+            retry_log_groups, failure_summary = None, None
         else:
             cfn_event = event['detail']['cfnEvent']
             start_log_group = event['detail']['next']
+            retry_log_groups = event['detail'].get('retry')
+            failure_summary = event['detail'].get('failed')
 
         # This code exists so that lambda failures don't fail silently and indefinitely block
         # the CloudFormation stack creation progress. Instead, this code tries to make it so that users
@@ -341,9 +1672,12 @@ def rest_of_main(
                     client_wrapper,
                     cfn_event,
                     start_log_group,
-                    matches,
-                    exclusions,
-                    args))
+                    configs,
+                    journal_store,
+                    retry_log_groups,
+                    failure_summary,
+                    tag_index,
+                    defer_dormant))
             cancel_thread = threading.Thread(
                 target=send_cfnresponse_5s_before_timeout, args=(
                     client_wrapper, timeout, cfn_event))
@@ -362,8 +1696,42 @@ def rest_of_main(
                 'CreateLogGroup failed, cannot create subscription filter')
         else:
             name = event['detail']['requestParameters']['logGroupName']
-            if should_subscribe(name, matches, exclusions):
-                _ = modify_subscription(client_wrapper, True, name, args)
+            dedup_key = None
+            if dedup_cache is not None:
+                # Duplicate deliveries share the CloudTrail event ID. A log group that was deleted and
+                # created again has a new one, and must not be mistaken for a duplicate.
+                event_id = event['detail'].get('eventID') or event['detail'].get('eventTime', '')
+                dedup_key = name + ':' + event_id + ':' + config_fingerprint(configs)
+                found = dedup_cache.contains(dedup_key)
+                logger.info('dedup cache %s for log group %s (hits=%d misses=%d hit rate=%.2f)',
+                            'hit' if found else 'miss', name,
+                            dedup_cache.hits, dedup_cache.misses, dedup_cache.hit_rate())
+                if found:
+                    return
+            # State cached before the log group was created belongs to a deleted log group of the
+            # same name. State cached since, e.g. while handling a duplicate delivery, is kept.
+            created_at = event_time(event['detail'])
+            client_wrapper.forget_subscription_state(
+                name, None if created_at is None else created_at + SUBSCRIPTION_STATE_CLOCK_SKEW_SECONDS)
+            reason = ineligible_reason(event['detail']['requestParameters'])
+            if reason is not None:
+                logger.info('log group %s cannot be subscribed to: %s', name, reason)
+                return
+            # A new log group only has the tags it was created with.
+            tags = event['detail']['requestParameters'].get('tags') or {}
+            if tag_index is not None:
+                tag_index.put(name, tags)
+            selected = selected_subscription_args(name, configs, tags)
+            if selected:
+                results = modify_log_group_subscriptions(
+                    client_wrapper, True, name, selected)
+                if dedup_key is not None and all(results):
+                    dedup_cache.add(dedup_key)
+    elif is_scheduled_event:
+        logger.info('assuming event is a scheduled event')
+        process_scheduled_event(client_wrapper, configs,
+                                journal_store if journal_store is not None else LocalCheckpointStore(),
+                                tag_index)
     else:
         logger.error('failed to determine event type')
 
@@ -378,6 +1746,10 @@ def main(event, context):
     If the event is a CloudFormation Customer Resource Create event, main scans through
     all log groups and creates subscription filters. Subscr
 
+    If the event is a CloudFormation Customer Resource Update event, main scans through
+    all log groups and only modifies the subscription filters of log groups that the previous
+    configuration, found in the custom resource's Configuration property, selected differently.
+
     If the event is a CloudFormation Customer Resource Delete event, main scans through
     all log groups and deletes subscription filters.
 
@@ -388,6 +1760,7 @@ def main(event, context):
     Whether a subscription filter gets created is controlled by the following environment variables:
     - LOG_GROUP_MATCHES
     - LOG_GROUP_EXCLUDES
+    - LOG_GROUP_TAG_SELECTORS
 
     The Subscription filter configuration is controlled by the following environment variables:
     - FILTER_NAME
@@ -395,28 +1768,45 @@ def main(event, context):
     - DESTINATION_ARN
     - DELIVERY_STREAM_ROLE_ARN
 
+    If the optional DESTINATION_ARN_POOL is a comma-separated list of destination ARNs, it replaces
+    DESTINATION_ARN, and each log group is sent to the pool member assigned to it by consistent hashing.
+
+    ADDITIONAL_SUBSCRIPTIONS is an optional JSON list of further subscription configurations, each
+    with its own log group matches and excludes. See parse_subscription_configs.
+
+    If DEFER_DORMANT_LOG_GROUPS is true, log groups that have never stored any data are not
+    subscribed to by CloudFormation events. Scheduled events subscribe them once they have.
+
+    Progress through CloudFormation events is journaled in the DynamoDB table named by the optional
+    STATE_TABLE_NAME environment variable, or in memory if it is not set. Recently handled CreateLogGroup
+    events are remembered in memory, and in the same table if it is set.
+
     The timeout environment variable is supposed to be the lambda timeout. It exists to prevent
     the issue described in https://observe.atlassian.net/browse/OB-12739.
 
     See relevant terraform variables for a description of what these variables are supposed to do.
     """
-    matchStr = os.environ['LOG_GROUP_MATCHES']
-    exclusionStr = os.environ['LOG_GROUP_EXCLUDES']
-    filter_name = os.environ['FILTER_NAME']
-    filter_pattern = os.environ['FILTER_PATTERN']
-    destination_arn = os.environ['DESTINATION_ARN']
-    delivery_role = os.environ['DELIVERY_STREAM_ROLE_ARN']
-    timeout = os.environ['TIMEOUT']
-
-    matches = matchStr.split(',') if matchStr != "" else []
-    exclusions = exclusionStr.split(',') if exclusionStr != "" else []
-    args = SubscriptionArgs(destination_arn, filter_name,
-                            filter_pattern, delivery_role)
-    timeout = int(timeout)
+    configs = load_subscription_configs(os.environ)
+    timeout = int(os.environ['TIMEOUT'])
+    state_table_name = os.environ.get('STATE_TABLE_NAME', '')
+    defer_dormant = os.environ.get('DEFER_DORMANT_LOG_GROUPS', 'false').lower() == 'true'
 
     logger.info('received event: %s', event)
 
     client_wrapper = AWSWrapper(boto3.client(
-        'logs'), boto3.client('events'), context)
+        'logs'), boto3.client('events'), context, subscription_state_cache)
+
+    if state_table_name != "":
+        journal_store = DynamoDBCheckpointStore(
+            boto3.client('dynamodb'), state_table_name)
+    else:
+        journal_store = local_checkpoint_store
+
+    # Duplicate deliveries are only shared across execution environments if there is a state table.
+    new_log_group_dedup_cache.shared_store = journal_store if state_table_name != "" else None
 
-    rest_of_main(event, client_wrapper, matches, exclusions, args, timeout)
+    primary = configs[0]
+    rest_of_main(event, client_wrapper, primary.matches, primary.exclusions,
+                 primary.args, timeout, configs[1:], journal_store,
+                 new_log_group_dedup_cache, log_group_tag_index, primary.tag_selectors,
+                 defer_dormant)
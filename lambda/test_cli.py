@@ -0,0 +1,102 @@
+import io
+import json
+import unittest
+
+from cli import parse_args, run
+from index import MAX_SUBSCRIPTIONS_PER_INVOCATION, LocalCheckpointStore, ProgressJournal, SubscriptionArgs, SubscriptionConfig, load_subscription_configs, rest_of_main
+from test_index import FAKE_CFN_CREATE_EVENT, FakeWrapper
+
+
+class TestRun(unittest.TestCase):
+    """TestRun contains test cases for running the reconciliation outside of Lambda."""
+
+    def test_create_without_budget(self):
+        log_groups = [
+            f"/aws/lambda/func{i:03}" for i in range(2 * MAX_SUBSCRIPTIONS_PER_INVOCATION + 1)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        configs = [SubscriptionConfig([".*"], [], args)]
+        out = io.StringIO()
+
+        ok = run(wrapper, True, configs, None, 8, None, out)
+
+        self.assertTrue(ok)
+        self.assertEqual(set(wrapper.subscription_filters), set(log_groups))
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        # Progress is reported in name order, so that any reported name is a
+        # safe point to resume from.
+        self.assertEqual([line['logGroupName'] for line in lines[:-1]], log_groups)
+        self.assertEqual(lines[-1], {
+            'ok': True,
+            'count': len(log_groups),
+            'failed': {'count': 0, 'errors': {}, 'log_groups': [], 'ineligible': {}, 'deferred': 0},
+        })
+
+    def test_resume(self):
+        log_groups = [f"/aws/lambda/func{i}" for i in range(10)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        configs = [SubscriptionConfig([".*"], [], args)]
+
+        ok = run(wrapper, True, configs, "/aws/lambda/func5", 4, None, io.StringIO())
+
+        self.assertTrue(ok)
+        self.assertEqual(set(wrapper.subscription_filters), set(log_groups[5:]))
+
+    def test_journal_left_for_lambda(self):
+        log_groups = [f"/aws/lambda/func{i}" for i in range(10)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        configs = [SubscriptionConfig([".*"], [], args)]
+        store = LocalCheckpointStore()
+
+        ok = run(wrapper, True, configs, None, 4, ProgressJournal(store, configs), io.StringIO())
+        self.assertTrue(ok)
+
+        # The Lambda function's initial run skips what the CLI already did.
+        wrapper.record = []
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, 10, None, store)
+        self.assertEqual([r[0] for r in wrapper.record],
+                         ["describe_log_groups_paginator", "send_cfnresponse"])
+        self.assertEqual(wrapper.record[-1][2], "SUCCESS")
+
+    def test_journal_left_for_lambda_with_destination_pool(self):
+        log_groups = [f"/aws/lambda/func{i}" for i in range(10)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        pool = ["fake-destination-arn-1", "fake-destination-arn-2"]
+        store = LocalCheckpointStore()
+
+        # The CLI is only given the pool, while the Lambda function's DESTINATION_ARN is the
+        # pool's first member.
+        configs = load_subscription_configs({
+            "LOG_GROUP_MATCHES": ".*",
+            "LOG_GROUP_EXCLUDES": "",
+            "DESTINATION_ARN": "",
+            "DESTINATION_ARN_POOL": ",".join(pool),
+            "DELIVERY_STREAM_ROLE_ARN": "fake-role-arn",
+            "FILTER_NAME": "my-filter",
+            "FILTER_PATTERN": "",
+        })
+        ok = run(wrapper, True, configs, None, 4, ProgressJournal(store, configs), io.StringIO())
+        self.assertTrue(ok)
+
+        wrapper.record = []
+        args = SubscriptionArgs(pool[0], "my-filter", "", "fake-role-arn", pool)
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, 10, None, store)
+        self.assertEqual([r[0] for r in wrapper.record],
+                         ["describe_log_groups_paginator", "send_cfnresponse"])
+
+    def test_parse_args(self):
+        args = parse_args(["delete", "--destination-arn", "fake-destination-arn",
+                           "--role-arn", "fake-role-arn", "--concurrency", "32"])
+        self.assertEqual(args.action, "delete")
+        self.assertEqual(args.concurrency, 32)
+        with self.assertRaises(SystemExit):
+            parse_args(["create"])
+
+
+if __name__ == '__main__':
+    unittest.main()
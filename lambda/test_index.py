@@ -1,9 +1,17 @@
+import copy
 import dataclasses
+import datetime
 import json
 import typing
 import unittest
 
-from index import EVENTBRIDGE_SOURCE, MAX_SUBSCRIPTIONS_PER_INVOCATION, rest_of_main, SubscriptionArgs
+from botocore.exceptions import ClientError
+
+import index
+from index import EVENTBRIDGE_SOURCE, MAX_SUBSCRIPTIONS_PER_INVOCATION, rest_of_main, DedupCache, LocalCheckpointStore, SubscriptionArgs, TagIndex, SubscriptionConfig
+
+# Retries of failed log groups should not slow down the tests.
+index.RETRY_DELAY_SECONDS = 0
 
 # From
 # https://docs.aws.amazon.com/lambda/latest/dg/services-cloudformation.html
@@ -36,6 +44,31 @@ FAKE_CFN_DELETE_EVENT = {
 }
 
 
+def fake_cfn_update_event(old_matches, old_args, new_matches, new_args):
+    """fake_cfn_update_event returns an Update event moving from the old to the new subscription config."""
+    def configuration(matches, args):
+        return {
+            "LOG_GROUP_MATCHES": ",".join(matches),
+            "LOG_GROUP_EXCLUDES": "",
+            "DESTINATION_ARN": args.destination_arn,
+            "DESTINATION_ARN_POOL": ",".join(args.destination_pool),
+            "DELIVERY_STREAM_ROLE_ARN": args.role_arn,
+            "FILTER_NAME": args.filter_name,
+            "FILTER_PATTERN": args.filter_pattern,
+            "ADDITIONAL_SUBSCRIPTIONS": "[]",
+            "VERSION": "1",
+        }
+    event = copy.deepcopy(FAKE_CFN_CREATE_EVENT)
+    event["RequestType"] = "Update"
+    event["PhysicalResourceId"] = "fake-physical-resource-id"
+    event["OldResourceProperties"] = copy.deepcopy(event["ResourceProperties"])
+    event["OldResourceProperties"]["Configuration"] = configuration(
+        old_matches, old_args)
+    event["ResourceProperties"]["Configuration"] = configuration(
+        new_matches, new_args)
+    return event
+
+
 @dataclasses.dataclass
 class FakeContext:
     log_stream_name: str
@@ -44,15 +77,25 @@ class FakeContext:
 FAKE_CONTEXT = FakeContext("fake-log-stream-name")
 
 
+def fake_log_group_arn(name: str) -> str:
+    return f"arn:aws:logs:us-east-2:123456789012:log-group:{name}"
+
+
 class FakeWrapper:
     """FakeWrapper is a AWSWrapper mock."""
 
     def __init__(self,
                  log_groups: typing.List[str],
                  subscription_filters: typing.Dict[str,
-                                                   typing.List[SubscriptionArgs]]) -> None:
+                                                   typing.List[SubscriptionArgs]],
+                 tags: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None,
+                 log_group_classes: typing.Optional[typing.Dict[str, str]] = None,
+                 stored_bytes: typing.Optional[typing.Dict[str, int]] = None) -> None:
         self.log_groups = log_groups
         self.subscription_filters = subscription_filters
+        self.tags = tags or {}
+        self.log_group_classes = log_group_classes or {}
+        self.stored_bytes = stored_bytes or {}
         self.record = []
 
     def describe_log_groups_paginator(self):
@@ -61,13 +104,19 @@ class FakeWrapper:
         ])
 
         class FakePaginator:
-            def __init__(self, log_groups) -> None:
+            def __init__(self, log_groups, log_group_classes, stored_bytes) -> None:
                 self.log_groups = log_groups
+                self.log_group_classes = log_group_classes
+                self.stored_bytes = stored_bytes
 
             def paginate(self):
-                return [{"logGroups": [{"logGroupName": name}
+                return [{"logGroups": [{"logGroupName": name,
+                                        "logGroupArn": fake_log_group_arn(name),
+                                        "logGroupClass": self.log_group_classes.get(name, "STANDARD"),
+                                        "creationTime": 0,
+                                        "storedBytes": self.stored_bytes.get(name, 1)}
                                        for name in self.log_groups]}]
-        return FakePaginator(self.log_groups)
+        return FakePaginator(self.log_groups, self.log_group_classes, self.stored_bytes)
 
     def describe_subscription_filters(self, **kwargs):
         self.record.append([
@@ -97,7 +146,10 @@ class FakeWrapper:
             kwargs['filterPattern'],
             kwargs['roleArn'])
         if kwargs['logGroupName'] in self.subscription_filters:
-            self.subscription_filters[kwargs['logGroupName']].append(args)
+            # Putting a filter with an existing name replaces it.
+            filters = [a for a in self.subscription_filters[kwargs['logGroupName']]
+                       if a.filter_name != kwargs['filterName']]
+            self.subscription_filters[kwargs['logGroupName']] = filters + [args]
         else:
             self.subscription_filters[kwargs['logGroupName']] = [args]
 
@@ -112,6 +164,17 @@ class FakeWrapper:
             if len(self.subscription_filters[kwargs['logGroupName']]) == 0:
                 del self.subscription_filters[kwargs['logGroupName']]
 
+    def forget_subscription_state(self, log_group_name=None, changed_at=None):
+        pass
+
+    def list_tags_for_resource(self, **kwargs):
+        self.record.append([
+            "list_tags_for_resource",
+            kwargs
+        ])
+        name = kwargs["resourceArn"].split(":log-group:", 1)[1]
+        return {"tags": self.tags.get(name, {})}
+
     def put_events(self, **kwargs):
         self.record.append([
             "put_events",
@@ -462,6 +525,854 @@ class TestRestOfMain(unittest.TestCase):
                     role_arn='fake-role-arn')]}
         self.assertEqual(wrapper.subscription_filters, expected)
 
+    def test_additional_configs(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        other_args = SubscriptionArgs("fake-kinesis-arn",
+                                      "my-other-filter", "ERROR", "fake-other-role-arn")
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        wrapper = FakeWrapper(log_groups=log_groups,
+                              subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        additional_configs = [SubscriptionConfig(
+            ["/aws/lambda/.*"], ["/aws/lambda/func2"], other_args)]
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT,
+                     wrapper, matches, exclusions, args, timeout, additional_configs)
+
+        expected = {
+            '/aws/bean/nginx1': [args],
+            '/aws/lambda/func1': [args, other_args],
+            '/aws/lambda/func2': [args]}
+        self.assertEqual(wrapper.subscription_filters, expected)
+
+        # The log groups are listed once, and each log group's filters are
+        # described once.
+        ops = [r[0] for r in wrapper.record]
+        self.assertEqual(ops.count("describe_log_groups_paginator"), 1)
+        self.assertEqual(ops.count("describe_subscription_filters"), 3)
+
+        rest_of_main(FAKE_CFN_DELETE_EVENT,
+                     wrapper, matches, exclusions, args, timeout, additional_configs)
+        self.assertEqual(wrapper.subscription_filters, {})
+
+    def test_additional_configs_filter_slots(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        other_args = SubscriptionArgs("fake-kinesis-arn",
+                                      "my-other-filter", "", "fake-other-role-arn")
+        foreign_args = SubscriptionArgs("foreign-destination-arn",
+                                        "foreign-filter", "", "foreign-role-arn")
+        wrapper = FakeWrapper(log_groups=["/aws/lambda/func1"],
+                              subscription_filters={"/aws/lambda/func1": [foreign_args]})
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout,
+                     [SubscriptionConfig([".*"], [], other_args)])
+
+        # The primary config takes the last free slot.
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/lambda/func1": [foreign_args, args]})
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+
+    def test_journal_resume(self):
+        log_groups = [
+            f"/aws/lambda/func{i:03}" for i in range(MAX_SUBSCRIPTIONS_PER_INVOCATION + 1)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        timeout = 10
+        store = LocalCheckpointStore()
+
+        # The first invocation pages, but the pagination event is never
+        # delivered, e.g. because the stack timed out.
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, matches,
+                     exclusions, args, timeout, None, store)
+        self.assertEqual(wrapper.record[-1][0], "put_events")
+
+        # Retrying the create only visits the remaining log group.
+        wrapper.record = []
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, matches,
+                     exclusions, args, timeout, None, store)
+        described = [r[1]["logGroupName"] for r in wrapper.record
+                     if r[0] == "describe_subscription_filters"]
+        self.assertEqual(described, [log_groups[-1]])
+        self.assertEqual(wrapper.record[-1][0], "send_cfnresponse")
+        self.assertEqual(wrapper.record[-1][2], "SUCCESS")
+        self.assertEqual(len(wrapper.subscription_filters), len(log_groups))
+
+        # A finished run clears the journal.
+        wrapper.record = []
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, matches,
+                     exclusions, args, timeout, None, store)
+        described = [r for r in wrapper.record
+                     if r[0] == "describe_subscription_filters"]
+        self.assertEqual(len(described), MAX_SUBSCRIPTIONS_PER_INVOCATION)
+
+    def test_journal_delete_invalidates_create(self):
+        log_groups = [
+            f"/aws/lambda/func{i:03}" for i in range(MAX_SUBSCRIPTIONS_PER_INVOCATION + 1)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        timeout = 10
+        store = LocalCheckpointStore()
+
+        # A partial create, followed by a partial rollback.
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, matches,
+                     exclusions, args, timeout, None, store)
+        rest_of_main(FAKE_CFN_DELETE_EVENT, wrapper, matches,
+                     exclusions, args, timeout, None, store)
+        self.assertEqual(wrapper.subscription_filters, {})
+
+        # Log groups cleaned up by the delete are subscribed again.
+        wrapper.record = []
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, matches,
+                     exclusions, args, timeout, None, store)
+        self.assertEqual(wrapper.record[-1][0], "put_events")
+        self.assertEqual(len(wrapper.subscription_filters),
+                         MAX_SUBSCRIPTIONS_PER_INVOCATION)
+
+    def test_journal_chunks(self):
+        configs = [SubscriptionConfig([".*"], [], SubscriptionArgs(
+            "fake-destination-arn", "my-filter", "", "fake-role-arn"))]
+        store = LocalCheckpointStore()
+        journal = index.ProgressJournal(store, configs)
+        # Every other log group fails, so each completed log group is a range of its own.
+        for i in range(index.JOURNAL_CHUNK_SIZE * 2 + 1):
+            journal.mark_done(f"/aws/lambda/func{i * 2:04}", True)
+            journal.break_range()
+        journal.flush()
+        self.assertEqual(store.load(journal.key)["chunks"], 3)
+        for i in range(3):
+            self.assertLessEqual(len(store.load(f"{journal.key}:{i}")["ranges"]),
+                                 index.JOURNAL_CHUNK_SIZE)
+        self.assertEqual(index.ProgressJournal(store, configs).ranges, journal.ranges)
+
+        # Only the chunks that changed are saved again.
+        saved = []
+        save = store.save
+        store.save = lambda key, value, ttl_seconds: (saved.append(key), save(key, value, ttl_seconds))
+        journal.mark_done("/aws/lambda/func9999", True)
+        journal.flush()
+        self.assertEqual(saved, [journal.key + ":2", journal.key])
+        self.assertTrue(index.ProgressJournal(store, configs).is_done("/aws/lambda/func9999", True))
+
+        # A journal with a missing chunk is empty.
+        store.delete(journal.key + ":1")
+        self.assertEqual(index.ProgressJournal(store, configs).ranges, [])
+
+        journal.clear()
+        self.assertEqual(store.items, {})
+
+    def test_new_log_group_duplicate_events(self):
+        wrapper = FakeWrapper(log_groups=["/aws/bean/nginx1"],
+                              subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        timeout = 10
+        shared_store = LocalCheckpointStore()
+        dedup_cache = DedupCache(60, 10, shared_store)
+
+        create_log_group_event = {
+            "source": "aws.logs",
+            "detail": {
+                "eventID": "fake-event-id-1",
+                "eventTime": "2024-01-01T00:00:00Z",
+                "requestParameters": {
+                    "logGroupName": "/aws/bean/nginx1",
+                }
+            }
+        }
+
+        rest_of_main(create_log_group_event, wrapper, matches, exclusions,
+                     args, timeout, None, None, dedup_cache)
+        self.assertEqual(len(wrapper.record), 2)
+
+        # Duplicates are dropped before any AWS API call, including duplicates
+        # delivered to another execution environment.
+        rest_of_main(create_log_group_event, wrapper, matches, exclusions,
+                     args, timeout, None, None, dedup_cache)
+        rest_of_main(create_log_group_event, wrapper, matches, exclusions,
+                     args, timeout, None, None, DedupCache(60, 10, shared_store))
+        self.assertEqual(len(wrapper.record), 2)
+        self.assertEqual(dedup_cache.hits, 1)
+        self.assertEqual(dedup_cache.misses, 1)
+
+        # A different configuration is not a duplicate.
+        other_args = SubscriptionArgs("fake-other-destination-arn",
+                                      "my-other-filter", "", "fake-role-arn")
+        rest_of_main(create_log_group_event, wrapper, matches, exclusions,
+                     other_args, timeout, None, None, dedup_cache)
+        self.assertEqual(wrapper.record[-1][0], "put_subscription_filter")
+
+        # A log group that was deleted and created again is not a duplicate.
+        del wrapper.subscription_filters["/aws/bean/nginx1"]
+        recreated_event = copy.deepcopy(create_log_group_event)
+        recreated_event["detail"]["eventID"] = "fake-event-id-2"
+        recreated_event["detail"]["eventTime"] = "2024-01-01T00:01:00Z"
+        rest_of_main(recreated_event, wrapper, matches, exclusions,
+                     args, timeout, None, None, dedup_cache)
+        self.assertEqual(wrapper.subscription_filters, {"/aws/bean/nginx1": [args]})
+
+    def test_dedup_cache_bounds(self):
+        dedup_cache = DedupCache(60, 2)
+        for key in ["a", "b", "c"]:
+            dedup_cache.add(key)
+        self.assertFalse(dedup_cache.contains("a"))
+        self.assertTrue(dedup_cache.contains("c"))
+        self.assertEqual(dedup_cache.hit_rate(), 0.5)
+
+        expired = DedupCache(0, 2)
+        expired.add("a")
+        self.assertFalse(expired.contains("a"))
+
+    def test_failures_retried(self):
+        class FakeThrottledWrapper(FakeWrapper):
+            throttled = {"/aws/lambda/func1"}
+
+            def put_subscription_filter(self, **kwargs):
+                if kwargs["logGroupName"] in self.throttled:
+                    self.throttled.remove(kwargs["logGroupName"])
+                    raise ClientError(
+                        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+                        "PutSubscriptionFilter")
+                return super().put_subscription_filter(**kwargs)
+
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        wrapper = FakeThrottledWrapper(log_groups=log_groups,
+                                       subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT,
+                     wrapper, matches, exclusions, args, timeout)
+
+        # The throttled log group is retried at the end of the invocation.
+        self.assertEqual(set(wrapper.subscription_filters), set(log_groups))
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+        self.assertEqual(last_record[3], {})
+
+    def test_failures_reported(self):
+        class FakeBrokenWrapper(FakeWrapper):
+            def put_subscription_filter(self, **kwargs):
+                self.record.append(["put_subscription_filter_attempt", kwargs])
+                if kwargs["logGroupName"] == "/aws/lambda/func2":
+                    raise ClientError(
+                        {"Error": {"Code": "InvalidParameterException", "Message": "Bad log group"}},
+                        "PutSubscriptionFilter")
+                return super().put_subscription_filter(**kwargs)
+
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        wrapper = FakeBrokenWrapper(log_groups=log_groups,
+                                    subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT,
+                     wrapper, matches, exclusions, args, timeout)
+
+        # Permanent failures are not retried.
+        puts = [r for r in wrapper.record if r[0] == "put_subscription_filter_attempt"]
+        self.assertEqual(len(puts), 3)
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+        self.assertEqual(last_record[3], {
+            'FailedLogGroupCount': 1,
+            'FailedLogGroupErrors': '{"InvalidParameterException": 1}',
+            'FailedLogGroups': '/aws/lambda/func2',
+        })
+
+    def test_failures_carried_forward(self):
+        class FakeThrottledWrapper(FakeWrapper):
+            throttles = 2
+
+            def put_subscription_filter(self, **kwargs):
+                if kwargs["logGroupName"] == "/aws/lambda/func000" and self.throttles > 0:
+                    self.throttles -= 1
+                    raise ClientError(
+                        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+                        "PutSubscriptionFilter")
+                return super().put_subscription_filter(**kwargs)
+
+        log_groups = [
+            f"/aws/lambda/func{i:03}" for i in range(MAX_SUBSCRIPTIONS_PER_INVOCATION + 1)]
+        wrapper = FakeThrottledWrapper(log_groups=log_groups,
+                                       subscription_filters={})
+        matches = [".*"]
+        exclusions = []
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT,
+                     wrapper, matches, exclusions, args, timeout)
+
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "put_events")
+        detail = json.loads(last_record[1]['Entries'][0]['Detail'])
+        self.assertEqual(detail['retry'], ["/aws/lambda/func000"])
+
+        eventBridgeEvent = {
+            "source": last_record[1]['Entries'][0]['Source'],
+            "detail": detail,
+        }
+        rest_of_main(eventBridgeEvent,
+                     wrapper, matches, exclusions, args, timeout)
+
+        self.assertEqual(set(wrapper.subscription_filters), set(log_groups))
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+        self.assertEqual(last_record[3], {})
+
+    def test_failures_bounded(self):
+        failures = index.FailureTracker()
+        names = ["/aws/lambda/" + "x" * 500 + "%03d" % i for i in range(150)]
+        for name in names:
+            failures.record(name, "ThrottlingException")
+
+        # Only so many retries are carried forward to the next pagination event.
+        self.assertEqual(failures.carry_forward(index.MAX_CARRIED_RETRIES),
+                         names[:index.MAX_CARRIED_RETRIES])
+        self.assertEqual(failures.summary['count'], 150 - index.MAX_CARRIED_RETRIES)
+
+        # Reported log group names fit in a CloudFormation response.
+        data = failures.response_data()
+        self.assertEqual(data['FailedLogGroupCount'], 150 - index.MAX_CARRIED_RETRIES)
+        self.assertLessEqual(len(data['FailedLogGroups'].encode()), index.MAX_REPORTED_FAILURES_BYTES)
+        self.assertEqual(data['FailedLogGroups'],
+                         names[index.MAX_CARRIED_RETRIES])
+
+    def test_update_matches(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={
+            "/aws/lambda/func1": [args],
+            "/aws/lambda/func2": [args],
+        })
+        timeout = 10
+
+        # Only the newly matched log group is touched.
+        event = fake_cfn_update_event(["/aws/lambda/.*"], args, [".*"], args)
+        rest_of_main(event, wrapper, [".*"], [], args, timeout)
+        touched = [(r[0], r[1]["logGroupName"]) for r in wrapper.record
+                   if r[0] != "describe_log_groups_paginator" and r[0] != "send_cfnresponse"]
+        self.assertEqual(touched, [
+            ("describe_subscription_filters", "/aws/bean/nginx1"),
+            ("put_subscription_filter", "/aws/bean/nginx1"),
+        ])
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+
+        # Log groups that are no longer matched are cleaned up.
+        wrapper.record = []
+        event = fake_cfn_update_event([".*"], args, ["/aws/bean/.*"], args)
+        rest_of_main(event, wrapper, ["/aws/bean/.*"], [], args, timeout)
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/bean/nginx1": [args]})
+        self.assertEqual(
+            len([r for r in wrapper.record if r[0] == "describe_subscription_filters"]), 2)
+
+    def test_update_pattern_in_place(self):
+        old_args = SubscriptionArgs("fake-destination-arn",
+                                    "my-filter", "", "fake-role-arn")
+        new_args = SubscriptionArgs("fake-destination-arn",
+                                    "my-filter", "ERROR", "fake-role-arn")
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+        ]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={
+            "/aws/lambda/func1": [old_args],
+            "/aws/lambda/func2": [old_args],
+        })
+        timeout = 10
+
+        event = fake_cfn_update_event([".*"], old_args, [".*"], new_args)
+        rest_of_main(event, wrapper, [".*"], [], new_args, timeout)
+
+        ops = [r[0] for r in wrapper.record]
+        self.assertEqual(ops.count("put_subscription_filter"), 2)
+        self.assertEqual(ops.count("delete_subscription_filter"), 0)
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/lambda/func1": [new_args],
+            "/aws/lambda/func2": [new_args],
+        })
+
+        # The physical resource ID must not change, or CloudFormation would
+        # replace the resource.
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+        self.assertEqual(last_record[4], "fake-physical-resource-id")
+
+    def test_update_version_bump(self):
+        old_args = SubscriptionArgs("fake-destination-arn",
+                                    "my-filter", "OLD", "fake-role-arn")
+        new_args = SubscriptionArgs("fake-destination-arn",
+                                    "my-filter", "NEW", "fake-role-arn")
+        other_args = SubscriptionArgs("fake-destination-arn",
+                                      "other-filter", "", "fake-role-arn")
+        wrapper = FakeWrapper(log_groups=["/aws/lambda/func1", "/aws/lambda/func2"],
+                              subscription_filters={
+                                  "/aws/lambda/func1": [old_args],
+                                  "/aws/lambda/func2": [other_args],
+                              })
+        timeout = 10
+
+        # Bumping VERSION puts every filter again, even if it sends to the same destination.
+        event = fake_cfn_update_event([".*"], old_args, [".*"], new_args)
+        event["ResourceProperties"]["Configuration"]["VERSION"] = "2"
+        rest_of_main(event, wrapper, [".*"], [], new_args, timeout)
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/lambda/func1": [new_args],
+            "/aws/lambda/func2": [other_args],
+        })
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+
+    def test_tag_selectors(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        tags = {
+            "/aws/lambda/func1": {"observe:subscribe": "true"},
+            "/aws/lambda/func2": {"observe:subscribe": "false"},
+            "/aws/bean/nginx1": {"observe:subscribe": "true"},
+        }
+        wrapper = FakeWrapper(log_groups=log_groups,
+                              subscription_filters={}, tags=tags)
+        tag_index = TagIndex()
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, ["/aws/lambda/.*"], [], args, timeout,
+                     None, None, None, tag_index, ["observe:subscribe=true"])
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/lambda/func1": [args]})
+
+        # Tags are only fetched for log groups that pass name filtering, and
+        # are cached across invocations.
+        listed = [r[1]["resourceArn"] for r in wrapper.record
+                  if r[0] == "list_tags_for_resource"]
+        self.assertEqual(sorted(listed), [
+            fake_log_group_arn("/aws/lambda/func1"),
+            fake_log_group_arn("/aws/lambda/func2"),
+        ])
+        wrapper.record = []
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, ["/aws/lambda/.*"], [], args, timeout,
+                     None, None, None, tag_index, ["observe:subscribe"])
+        self.assertEqual(
+            len([r for r in wrapper.record if r[0] == "list_tags_for_resource"]), 0)
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/lambda/func1": [args],
+            "/aws/lambda/func2": [args]})
+
+        # Delete ignores tags, so log groups whose tags changed are cleaned up too.
+        del wrapper.tags["/aws/lambda/func2"]
+        wrapper.record = []
+        delete_event = copy.deepcopy(FAKE_CFN_CREATE_EVENT)
+        delete_event["RequestType"] = "Delete"
+        rest_of_main(delete_event, wrapper, ["/aws/lambda/.*"], [], args, timeout,
+                     None, None, None, TagIndex(), ["observe:subscribe"])
+        self.assertEqual(wrapper.subscription_filters, {})
+        self.assertEqual(
+            len([r for r in wrapper.record if r[0] == "list_tags_for_resource"]), 0)
+
+    def test_new_log_group_tag_selectors(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        wrapper = FakeWrapper(log_groups=["/aws/bean/nginx1", "/aws/bean/nginx2"],
+                              subscription_filters={})
+        timeout = 10
+
+        for name, tags in [("/aws/bean/nginx1", {"observe:subscribe": "true"}),
+                           ("/aws/bean/nginx2", None)]:
+            create_log_group_event = {
+                "source": "aws.logs",
+                "detail": {
+                    "requestParameters": {
+                        "logGroupName": name,
+                        "tags": tags,
+                    }
+                }
+            }
+            rest_of_main(create_log_group_event, wrapper, [".*"], [], args, timeout,
+                         None, None, None, TagIndex(), ["observe:subscribe=true"])
+
+        # The tags in the event are used instead of listing them.
+        self.assertEqual(wrapper.subscription_filters, {
+            "/aws/bean/nginx1": [args]})
+        self.assertEqual(
+            len([r for r in wrapper.record if r[0] == "list_tags_for_resource"]), 0)
+
+    def test_ineligible_log_groups(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={},
+                              log_group_classes={"/aws/lambda/func2": "INFREQUENT_ACCESS"})
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout)
+
+        # Ineligible log groups cost no API calls, and are not failures.
+        described = [r[1]["logGroupName"] for r in wrapper.record
+                     if r[0] == "describe_subscription_filters"]
+        self.assertNotIn("/aws/lambda/func2", described)
+        self.assertEqual(set(wrapper.subscription_filters), {
+            "/aws/lambda/func1", "/aws/bean/nginx1"})
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+        self.assertEqual(last_record[3], {
+            'IneligibleLogGroupCount': 1,
+            'IneligibleLogGroupReasons': '{"logGroupClass=INFREQUENT_ACCESS": 1}',
+        })
+
+        create_log_group_event = {
+            "source": "aws.logs",
+            "detail": {
+                "requestParameters": {
+                    "logGroupName": "/aws/lambda/func3",
+                    "logGroupClass": "INFREQUENT_ACCESS",
+                }
+            }
+        }
+        wrapper.record = []
+        rest_of_main(create_log_group_event, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(wrapper.record, [])
+
+        # Under a tag selector, the tags of ineligible log groups are not fetched either.
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={},
+                              tags={name: {"team": "a"} for name in log_groups},
+                              log_group_classes={"/aws/lambda/func2": "INFREQUENT_ACCESS"})
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout,
+                     tag_selectors=["team=a"])
+        listed = [r[1]["resourceArn"] for r in wrapper.record
+                  if r[0] == "list_tags_for_resource"]
+        self.assertEqual(sorted(listed), sorted(
+            fake_log_group_arn(name) for name in ["/aws/lambda/func1", "/aws/bean/nginx1"]))
+        self.assertEqual(set(wrapper.subscription_filters), {
+            "/aws/lambda/func1", "/aws/bean/nginx1"})
+        self.assertEqual(wrapper.record[-1][3], {
+            'IneligibleLogGroupCount': 1,
+            'IneligibleLogGroupReasons': '{"logGroupClass=INFREQUENT_ACCESS": 1}',
+        })
+
+    def test_destination_pool(self):
+        pool = ["fake-destination-arn-1", "fake-destination-arn-2", "fake-destination-arn-3"]
+        args = SubscriptionArgs(pool[0], "my-filter", "", "fake-role-arn", pool)
+        log_groups = ["/aws/lambda/func%d" % i for i in range(60)]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={})
+        timeout = 10
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout)
+        assigned = {name: f[0].destination_arn
+                    for name, f in wrapper.subscription_filters.items()}
+        self.assertEqual(set(assigned), set(log_groups))
+        self.assertEqual(set(assigned.values()), set(pool))
+
+        # Growing the pool only moves a proportional slice of log groups, all to the new member.
+        grown_args = SubscriptionArgs(pool[0], "my-filter", "", "fake-role-arn",
+                                      pool + ["fake-destination-arn-4"])
+        wrapper.record = []
+        event = fake_cfn_update_event([".*"], args, [".*"], grown_args)
+        rest_of_main(event, wrapper, [".*"], [], grown_args, timeout)
+        moved = {name for name, f in wrapper.subscription_filters.items()
+                 if f[0].destination_arn != assigned[name]}
+        self.assertGreater(len(moved), 0)
+        self.assertLess(len(moved), len(log_groups) / 2)
+        self.assertEqual({wrapper.subscription_filters[name][0].destination_arn for name in moved},
+                         {"fake-destination-arn-4"})
+        ops = [r[0] for r in wrapper.record]
+        self.assertEqual(ops.count("describe_subscription_filters"), len(moved))
+        self.assertEqual(ops.count("put_subscription_filter"), len(moved))
+        self.assertEqual(ops.count("delete_subscription_filter"), 0)
+
+    def test_destination_pool_drift(self):
+        pool = ["fake-destination-arn-1", "fake-destination-arn-2"]
+        args = SubscriptionArgs(pool[0], "my-filter", "", "fake-role-arn", pool)
+        name = "/aws/lambda/func1"
+        assigned = index.destination_ring(tuple(pool)).lookup(name)
+        other = pool[1] if assigned == pool[0] else pool[0]
+        other_args = SubscriptionArgs("fake-other-destination-arn",
+                                      "other-filter", "", "fake-role-arn")
+        wrapper = FakeWrapper(log_groups=[name], subscription_filters={
+            name: [other_args, SubscriptionArgs(other, "my-filter", "", "fake-role-arn")]})
+        timeout = 10
+
+        # The drifted filter is replaced in place, even though no filter slot is free.
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(wrapper.subscription_filters, {
+            name: [other_args, SubscriptionArgs(assigned, "my-filter", "", "fake-role-arn")]})
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+
+    def test_defer_dormant_log_groups(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        log_groups = [
+            "/aws/lambda/func1",
+            "/aws/lambda/func2",
+            "/aws/bean/nginx1",
+        ]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={},
+                              stored_bytes={"/aws/lambda/func2": 0, "/aws/bean/nginx1": 0})
+        store = LocalCheckpointStore()
+        timeout = 10
+        scheduled_event = {"source": "aws.events", "detail-type": "Scheduled Event"}
+
+        # Dormant log groups are not described during setup.
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        described = [r[1]["logGroupName"] for r in wrapper.record
+                     if r[0] == "describe_subscription_filters"]
+        self.assertEqual(described, ["/aws/lambda/func1"])
+        last_record = wrapper.record[-1]
+        self.assertEqual(last_record[0], "send_cfnresponse")
+        self.assertEqual(last_record[2], "SUCCESS")
+        self.assertEqual(last_record[3], {'DeferredLogGroupCount': 2})
+
+        # A scheduled event only subscribes deferred log groups once they have stored data.
+        wrapper.record = []
+        rest_of_main(scheduled_event, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(wrapper.record, [["describe_log_groups_paginator"]])
+
+        wrapper.stored_bytes["/aws/lambda/func2"] = 10
+        wrapper.record = []
+        rest_of_main(scheduled_event, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        described = [r[1]["logGroupName"] for r in wrapper.record
+                     if r[0] == "describe_subscription_filters"]
+        self.assertEqual(described, ["/aws/lambda/func2"])
+        self.assertEqual(set(wrapper.subscription_filters), {
+            "/aws/lambda/func1", "/aws/lambda/func2"})
+
+        configs = [SubscriptionConfig([".*"], [], args)]
+        self.assertEqual(index.DeferredLogGroups(store, configs).load(),
+                         ({"/aws/bean/nginx1"}, None))
+
+        # Without saved state, a scheduled event scans all log groups instead.
+        store = LocalCheckpointStore()
+        wrapper.subscription_filters = {}
+        rest_of_main(scheduled_event, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(set(wrapper.subscription_filters), {
+            "/aws/lambda/func1", "/aws/lambda/func2"})
+        self.assertEqual(index.DeferredLogGroups(store, configs).load(),
+                         ({"/aws/bean/nginx1"}, None))
+
+        # Delete forgets deferred log groups.
+        delete_event = copy.deepcopy(FAKE_CFN_CREATE_EVENT)
+        delete_event["RequestType"] = "Delete"
+        rest_of_main(delete_event, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(wrapper.subscription_filters, {})
+        self.assertIsNone(index.DeferredLogGroups(store, configs).load())
+
+    def test_defer_dormant_log_groups_journal(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        log_groups = ["/aws/lambda/func%03d" % i for i in range(150)]
+        dormant = log_groups[::10]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={},
+                              stored_bytes={name: 0 for name in dormant})
+        store = LocalCheckpointStore()
+        timeout = 10
+        scheduled_event = {"source": "aws.events", "detail-type": "Scheduled Event"}
+
+        # The first invocation times out before its pagination event is handled, and
+        # CloudFormation retries the Create from the start.
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(wrapper.record[-1][0], "put_events")
+        configs = [SubscriptionConfig([".*"], [], args)]
+        state = index.DeferredLogGroups(store, configs).load()
+
+        # Scheduled events leave the deferred log groups to the unfinished run.
+        wrapper.record = []
+        rest_of_main(scheduled_event, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(wrapper.record, [])
+        self.assertEqual(index.DeferredLogGroups(store, configs).load(), state)
+
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(wrapper.record[-1][0], "send_cfnresponse")
+        self.assertEqual(index.DeferredLogGroups(store, configs).load(), (set(dormant), None))
+
+        # Once they are active, every deferred log group is subscribed.
+        wrapper.stored_bytes = {}
+        rest_of_main(scheduled_event, wrapper, [".*"], [], args, timeout,
+                     journal_store=store, defer_dormant=True)
+        self.assertEqual(set(wrapper.subscription_filters), set(log_groups))
+
+    def test_defer_dormant_log_groups_interleaved(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        log_groups = ["/aws/lambda/func%04d" % i for i in range(3000)]
+        dormant = log_groups[::2]
+        wrapper = FakeWrapper(log_groups=log_groups, subscription_filters={},
+                              stored_bytes={name: 0 for name in dormant})
+        store = LocalCheckpointStore()
+        timeout = 10
+        configs = [SubscriptionConfig([".*"], [], args)]
+
+        # Every invocation times out before its pagination event is handled, and CloudFormation
+        # retries the Create from the start, which resumes from the journal.
+        invocations = 0
+        while True:
+            invocations += 1
+            rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout,
+                         journal_store=store, defer_dormant=True)
+            if wrapper.record[-1][0] == "send_cfnresponse":
+                break
+            # Deferred log groups don't break the journal's ranges, of which each retry adds one.
+            self.assertEqual(len(index.ProgressJournal(store, configs).ranges), invocations)
+        self.assertEqual(invocations, len(log_groups) // 2 // MAX_SUBSCRIPTIONS_PER_INVOCATION)
+        self.assertEqual(wrapper.record[-1][2], "SUCCESS")
+        self.assertEqual(set(wrapper.subscription_filters), set(log_groups[1::2]))
+        self.assertEqual(index.DeferredLogGroups(store, configs).load(), (set(dormant), None))
+
+    def test_subscription_state_cache(self):
+        args = SubscriptionArgs("fake-destination-arn",
+                                "my-filter", "", "fake-role-arn")
+        name = "/aws/lambda/func1"
+        create_log_group_event = {
+            "source": "aws.logs",
+            "detail": {
+                "requestParameters": {
+                    "logGroupName": name,
+                }
+            }
+        }
+        # FakeWrapper also stands in for the CloudWatch Logs client of a real AWSWrapper.
+        logs_client = FakeWrapper(log_groups=[name], subscription_filters={})
+        wrapper = index.AWSWrapper(logs_client, None, None, index.SubscriptionStateCache(60, 2))
+        timeout = 10
+
+        def ops():
+            ops = [r[0] for r in logs_client.record]
+            logs_client.record = []
+            return ops
+
+        rest_of_main(create_log_group_event, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(ops(), ["describe_subscription_filters", "put_subscription_filter"])
+
+        # Our own writes keep the cached state correct, so the log group is not described again.
+        self.assertEqual(index.modify_log_group_subscriptions(wrapper, True, name, [args]), [True])
+        self.assertEqual(ops(), [])
+        self.assertEqual(index.modify_log_group_subscriptions(wrapper, False, name, [args]), [True])
+        self.assertEqual(ops(), ["delete_subscription_filter"])
+        self.assertEqual(index.modify_log_group_subscriptions(wrapper, True, name, [args]), [True])
+        self.assertEqual(ops(), ["put_subscription_filter"])
+        self.assertEqual(logs_client.subscription_filters, {name: [args]})
+
+        # A new log group of the same name has no filters, whatever was cached.
+        del logs_client.subscription_filters[name]
+        rest_of_main(create_log_group_event, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(ops(), ["describe_subscription_filters", "put_subscription_filter"])
+
+        # Filters cached after the log group was created are those of the same log group, so a
+        # duplicate delivery that the dedup cache missed makes no call. Filters cached before
+        # it was created are those of a deleted log group.
+        created_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=30)
+        timed_event = copy.deepcopy(create_log_group_event)
+        timed_event["detail"]["eventTime"] = created_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+        rest_of_main(timed_event, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(ops(), [])
+        recreated_event = copy.deepcopy(create_log_group_event)
+        recreated_event["detail"]["eventTime"] = datetime.datetime.now(
+            datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        del logs_client.subscription_filters[name]
+        rest_of_main(recreated_event, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(ops(), ["describe_subscription_filters", "put_subscription_filter"])
+
+        # CloudFormation events describe every log group, since another execution environment
+        # may have deleted the filters cached here.
+        del logs_client.subscription_filters[name]
+        logs_client.get_paginator = lambda operation_name: logs_client.describe_log_groups_paginator()
+        wrapper.send_cfnresponse = logs_client.send_cfnresponse
+        rest_of_main(FAKE_CFN_CREATE_EVENT, wrapper, [".*"], [], args, timeout)
+        self.assertEqual(ops(), ["describe_log_groups_paginator", "describe_subscription_filters",
+                                 "put_subscription_filter", "send_cfnresponse"])
+
+        # A failed write leaves the state unknown.
+        def fail(**kwargs):
+            raise ClientError({"Error": {"Code": "ThrottlingException"}}, "PutSubscriptionFilter")
+        logs_client.put_subscription_filter = fail
+        other_args = SubscriptionArgs("fake-other-destination-arn",
+                                      "other-filter", "", "fake-role-arn")
+        self.assertEqual(index.modify_log_group_subscriptions(wrapper, True, name, [other_args]), [False])
+        self.assertIsNone(wrapper.state_cache.get(name))
+
+    def test_subscription_state_cache_bounds(self):
+        cache = index.SubscriptionStateCache(60, 2)
+        cache.put("a", [])
+        cache.put("b", [])
+        self.assertEqual(cache.get("a"), [])
+        cache.put("c", [])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), [])
+
+        # Changes to returned state do not leak into the cache.
+        cache.put("a", [{"filterName": "my-filter"}])
+        cache.get("a").clear()
+        self.assertEqual(cache.get("a"), [{"filterName": "my-filter"}])
+
+        cache = index.SubscriptionStateCache(0, 2)
+        cache.put("a", [])
+        self.assertIsNone(cache.get("a"))
+
 
 if __name__ == '__main__':
     unittest.main()
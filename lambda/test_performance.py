@@ -0,0 +1,278 @@
+"""test_performance guards the cost of modifying log groups, in AWS API calls and CPU time per log group.
+
+Performance regressions, like an extra describe or a retry loop, show up as additional calls per
+log group long before they show up in wall-clock time, so the budgets below are exact counts. Calls
+are counted below a real AWSWrapper, with its subscription state cache, so that regressions of the
+cache are caught as well.
+"""
+import collections
+import copy
+import datetime
+import json
+import logging
+import math
+import time
+import typing
+import unittest
+
+import index
+from index import EVENTBRIDGE_SOURCE, MAX_SUBSCRIPTIONS_PER_INVOCATION, rest_of_main, LocalCheckpointStore, SubscriptionArgs, SubscriptionConfig, TagIndex
+from test_index import FAKE_CFN_CREATE_EVENT, FakeWrapper
+
+# DescribeLogGroups returns at most this many log groups per page.
+DESCRIBE_LOG_GROUPS_PAGE_SIZE = 50
+
+# Operations that call the CloudWatch Logs API for a single log group.
+LOG_GROUP_OPERATIONS = {
+    "describe_subscription_filters",
+    "put_subscription_filter",
+    "delete_subscription_filter",
+    "list_tags_for_resource",
+}
+
+# Logs API calls allowed per log group, not counting DescribeLogGroups pages.
+MAX_CALLS_PER_NEW_LOG_GROUP = 2
+MAX_CALLS_PER_SUBSCRIBED_LOG_GROUP = 1
+MAX_CALLS_PER_DUPLICATE_NEW_LOG_GROUP = 0
+MAX_CALLS_PER_DELETED_LOG_GROUP = 2
+
+# CPU time per log group of subscribing CPU_TIME_LOG_GROUPS new log groups the way the Lambda function
+# does, invocation by invocation with a journal, with logging disabled, as measured when this test
+# was written. It includes listing and sorting every log group once per invocation. The test fails
+# if a run takes more than CPU_TIME_TOLERANCE times as long, which leaves room for slower machines.
+# Lower the baseline when an optimization lands, so that it stays optimized.
+CPU_TIME_LOG_GROUPS = 10000
+CPU_SECONDS_PER_LOG_GROUP_BASELINE = 100e-6
+CPU_TIME_TOLERANCE = 3
+
+ARGS = SubscriptionArgs("fake-destination-arn",
+                        "my-filter", "", "fake-role-arn")
+TIMEOUT = 10
+
+
+class FakeLogsClient(FakeWrapper):
+    """FakeLogsClient stands in for the CloudWatch Logs and EventBridge clients of an AWSWrapper.
+    It pages DescribeLogGroups like AWS does, and records every other call. The pages are built
+    once, so that listing costs no more CPU time than a client that parses a response."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.pages = 0
+        log_groups = [lg for page in super().describe_log_groups_paginator().paginate()
+                      for lg in page["logGroups"]]
+        self.record = []
+        self.log_group_pages = [{"logGroups": log_groups[i:i + DESCRIBE_LOG_GROUPS_PAGE_SIZE]}
+                                for i in range(0, len(log_groups), DESCRIBE_LOG_GROUPS_PAGE_SIZE)]
+
+    def get_paginator(self, operation_name: str):
+        assert operation_name == "describe_log_groups", operation_name
+        client = self
+
+        class CountingPaginator:
+            def paginate(self):
+                for page in client.log_group_pages:
+                    client.pages += 1
+                    yield page
+        return CountingPaginator()
+
+
+class CountingWrapper(index.AWSWrapper):
+    """CountingWrapper is an AWSWrapper, with a subscription state cache, around a FakeLogsClient.
+    It counts the Logs API calls made for each log group. CloudFormation responses are recorded
+    instead of being sent."""
+
+    def __init__(self, log_groups: typing.List[str],
+                 subscription_filters: typing.Dict[str, typing.List[SubscriptionArgs]]) -> None:
+        self.client = FakeLogsClient(log_groups=log_groups, subscription_filters=subscription_filters)
+        super().__init__(self.client, self.client, None, index.SubscriptionStateCache(
+            index.SUBSCRIPTION_STATE_TTL_SECONDS, index.SUBSCRIPTION_STATE_MAX_ENTRIES))
+
+    @property
+    def record(self) -> list:
+        return self.client.record
+
+    @property
+    def pages(self) -> int:
+        return self.client.pages
+
+    @property
+    def subscription_filters(self) -> typing.Dict[str, typing.List[SubscriptionArgs]]:
+        return self.client.subscription_filters
+
+    def send_cfnresponse(self, event, responseStatus, responseData,
+                         physicalResourceId=None, noEcho=False, reason=None):
+        self.client.send_cfnresponse(event, responseStatus, responseData,
+                                     physicalResourceId, noEcho, reason)
+
+    def calls_per_log_group(self) -> typing.Counter[str]:
+        calls = collections.Counter()
+        for r in self.record:
+            if r[0] in LOG_GROUP_OPERATIONS:
+                name = r[1].get("logGroupName") or r[1]["resourceArn"].split(":log-group:", 1)[1]
+                calls[name] += 1
+        return calls
+
+    def reset(self) -> None:
+        self.client.record = []
+        self.client.pages = 0
+
+
+def run_cfn_event(wrapper: CountingWrapper, event: dict,
+                  additional_configs: typing.Optional[typing.List[SubscriptionConfig]] = None,
+                  journal_store: typing.Optional[index.CheckpointStore] = None) -> int:
+    """run_cfn_event handles a CloudFormation event and the pagination events it sends, until a
+    response is sent. It returns the number of invocations."""
+    invocations = 0
+    while True:
+        invocations += 1
+        rest_of_main(event, wrapper, [".*"], [], ARGS, TIMEOUT, additional_configs,
+                     journal_store, None, TagIndex())
+        last_record = wrapper.record[-1]
+        if last_record[0] == "send_cfnresponse":
+            assert last_record[2] == "SUCCESS", last_record
+            return invocations
+        assert last_record[0] == "put_events", last_record
+        event = {
+            "source": EVENTBRIDGE_SOURCE,
+            "detail": json.loads(last_record[1]["Entries"][0]["Detail"]),
+        }
+
+
+def run_setup_event(wrapper: CountingWrapper, event: dict, journal_store: index.CheckpointStore) -> int:
+    """run_setup_event is run_cfn_event without the thread that responds before the Lambda
+    function times out, which only sleeps."""
+    configs = [SubscriptionConfig([".*"], [], ARGS)]
+    invocations = 0
+    start_log_group, retry_log_groups, failure_summary = None, None, None
+    while True:
+        invocations += 1
+        index.process_setup_event(wrapper, event, start_log_group, configs, journal_store,
+                                  retry_log_groups, failure_summary, TagIndex())
+        last_record = wrapper.record[-1]
+        if last_record[0] == "send_cfnresponse":
+            assert last_record[2] == "SUCCESS", last_record
+            return invocations
+        detail = json.loads(last_record[1]["Entries"][0]["Detail"])
+        start_log_group = detail["next"]
+        retry_log_groups, failure_summary = detail.get("retry"), detail.get("failed")
+
+
+class TestCallBudget(unittest.TestCase):
+    """TestCallBudget checks the number of Logs API calls made per log group."""
+
+    # Spans several invocations, so that pagination is covered.
+    log_groups = ["/aws/lambda/func%03d" % i
+                  for i in range(MAX_SUBSCRIPTIONS_PER_INVOCATION * 2 + 50)]
+
+    def assertWithinBudget(self, wrapper: CountingWrapper, invocations: int, budget: int) -> None:
+        calls = wrapper.calls_per_log_group()
+        if budget > 0:
+            self.assertEqual(set(calls), set(self.log_groups))
+        over = {name: n for name, n in calls.items() if n > budget}
+        self.assertEqual(over, {}, "log groups over a budget of %d calls" % budget)
+        # Each invocation lists the log groups once.
+        pages = math.ceil(len(self.log_groups) / DESCRIBE_LOG_GROUPS_PAGE_SIZE)
+        self.assertLessEqual(wrapper.pages, invocations * pages)
+
+    def test_create(self):
+        wrapper = CountingWrapper(log_groups=self.log_groups, subscription_filters={})
+        invocations = run_cfn_event(wrapper, FAKE_CFN_CREATE_EVENT)
+        self.assertEqual(invocations, 3)
+        self.assertWithinBudget(wrapper, invocations, MAX_CALLS_PER_NEW_LOG_GROUP)
+
+        # Re-creating in the same execution environment describes each log group again, since
+        # another execution environment may have changed its filters.
+        wrapper.reset()
+        invocations = run_cfn_event(wrapper, FAKE_CFN_CREATE_EVENT, journal_store=LocalCheckpointStore())
+        self.assertWithinBudget(wrapper, invocations, MAX_CALLS_PER_SUBSCRIBED_LOG_GROUP)
+
+        # Re-creating in a new execution environment only describes each log group.
+        wrapper = CountingWrapper(log_groups=self.log_groups,
+                                  subscription_filters=wrapper.subscription_filters)
+        invocations = run_cfn_event(wrapper, FAKE_CFN_CREATE_EVENT, journal_store=LocalCheckpointStore())
+        self.assertWithinBudget(wrapper, invocations, MAX_CALLS_PER_SUBSCRIBED_LOG_GROUP)
+
+    def test_delete(self):
+        wrapper = CountingWrapper(log_groups=self.log_groups, subscription_filters={
+            name: [ARGS] for name in self.log_groups})
+        delete_event = copy.deepcopy(FAKE_CFN_CREATE_EVENT)
+        delete_event["RequestType"] = "Delete"
+        invocations = run_cfn_event(wrapper, delete_event)
+        self.assertEqual(wrapper.subscription_filters, {})
+        self.assertWithinBudget(wrapper, invocations, MAX_CALLS_PER_DELETED_LOG_GROUP)
+
+    def test_additional_configs(self):
+        # Each log group is described once, however many configs select it.
+        other_args = SubscriptionArgs("fake-other-destination-arn",
+                                      "other-filter", "", "fake-role-arn")
+        additional_configs = [SubscriptionConfig([".*"], [], other_args)]
+        wrapper = CountingWrapper(log_groups=self.log_groups, subscription_filters={})
+        invocations = run_cfn_event(wrapper, FAKE_CFN_CREATE_EVENT, additional_configs)
+        self.assertWithinBudget(wrapper, invocations, MAX_CALLS_PER_NEW_LOG_GROUP + 1)
+        describes = collections.Counter(r[1]["logGroupName"] for r in wrapper.record
+                                        if r[0] == "describe_subscription_filters")
+        self.assertEqual(set(describes.values()), {1})
+
+    def test_new_log_group(self):
+        wrapper = CountingWrapper(log_groups=[], subscription_filters={})
+        create_log_group_event = {
+            "source": "aws.logs",
+            "detail": {
+                "requestParameters": {
+                    "logGroupName": "/aws/lambda/func1",
+                }
+            }
+        }
+        rest_of_main(create_log_group_event, wrapper, [".*"], [], ARGS, TIMEOUT)
+        self.assertEqual(wrapper.calls_per_log_group(), {
+            "/aws/lambda/func1": MAX_CALLS_PER_NEW_LOG_GROUP})
+        self.assertEqual(wrapper.pages, 0)
+
+    def test_duplicate_new_log_group(self):
+        # A duplicate delivery that reaches the same execution environment without a dedup cache
+        # hit, e.g. because its entry was evicted, is absorbed by the subscription state cache.
+        wrapper = CountingWrapper(log_groups=[], subscription_filters={})
+        created_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
+        create_log_group_event = {
+            "source": "aws.logs",
+            "detail": {
+                "eventID": "fake-event-id-1",
+                "eventTime": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "requestParameters": {
+                    "logGroupName": "/aws/lambda/func1",
+                }
+            }
+        }
+        rest_of_main(create_log_group_event, wrapper, [".*"], [], ARGS, TIMEOUT)
+        wrapper.reset()
+        rest_of_main(create_log_group_event, wrapper, [".*"], [], ARGS, TIMEOUT)
+        self.assertEqual(sum(wrapper.calls_per_log_group().values()),
+                         MAX_CALLS_PER_DUPLICATE_NEW_LOG_GROUP)
+
+
+class TestCPUTime(unittest.TestCase):
+    """TestCPUTime checks the CPU time spent per log group against a stored baseline."""
+
+    def test_create_cpu_time(self):
+        log_groups = ["/aws/lambda/func%05d" % i for i in range(CPU_TIME_LOG_GROUPS)]
+        best = math.inf
+        logging.disable(logging.CRITICAL)
+        try:
+            # The fastest of a few runs is the least affected by noise.
+            for _ in range(3):
+                wrapper = CountingWrapper(log_groups=log_groups, subscription_filters={})
+                start = time.process_time()
+                run_setup_event(wrapper, FAKE_CFN_CREATE_EVENT, LocalCheckpointStore())
+                best = min(best, time.process_time() - start)
+                self.assertEqual(len(wrapper.subscription_filters), CPU_TIME_LOG_GROUPS)
+        finally:
+            logging.disable(logging.NOTSET)
+        per_log_group = best / CPU_TIME_LOG_GROUPS
+        self.assertLessEqual(
+            per_log_group, CPU_SECONDS_PER_LOG_GROUP_BASELINE * CPU_TIME_TOLERANCE,
+            "%.1fus of CPU time per log group, baseline is %.1fus" % (
+                per_log_group * 1e6, CPU_SECONDS_PER_LOG_GROUP_BASELINE * 1e6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,22 +5,57 @@ locals {
   region    = data.aws_region.current.id
 
   subscription_filter_role_arn = var.iam_role_arn != "" ? var.iam_role_arn : aws_iam_role.subscription_filter[0].arn
+  destination_arn_pool         = length(var.additional_kinesis_firehoses) > 0 ? concat([var.kinesis_firehose.firehose_delivery_stream.arn], [for f in var.additional_kinesis_firehoses : f.firehose_delivery_stream.arn]) : []
+  passed_role_arns             = distinct(concat([local.subscription_filter_role_arn], [for s in var.additional_subscriptions : s.role_arn]))
+
+  # Deferred log groups are remembered in the state table, so deferring them requires it.
+  enable_state_table = var.enable_state_table || var.defer_dormant_log_groups
 
   function_name = var.name
   function_env_vars = {
     "LOG_GROUP_MATCHES"        = join(",", var.log_group_matches)
     "LOG_GROUP_EXCLUDES"       = join(",", var.log_group_excludes)
+    "LOG_GROUP_TAG_SELECTORS"  = join(",", var.log_group_tag_selectors)
     "DESTINATION_ARN"          = var.kinesis_firehose.firehose_delivery_stream.arn
+    "DESTINATION_ARN_POOL"     = join(",", local.destination_arn_pool)
     "DELIVERY_STREAM_ROLE_ARN" = local.subscription_filter_role_arn
     "FILTER_NAME"              = var.filter_name
     "FILTER_PATTERN"           = var.filter_pattern
     "TIMEOUT"                  = var.lambda_timeout
     "IGNORE_DELETE_ERRORS"     = var.ignore_delete_errors
+    "ADDITIONAL_SUBSCRIPTIONS" = jsonencode(var.additional_subscriptions)
+    "STATE_TABLE_NAME"         = local.enable_state_table ? aws_dynamodb_table.state[0].name : ""
+    "DEFER_DORMANT_LOG_GROUPS" = var.defer_dormant_log_groups
 
     # Bump VERSION if we want to re-create the subscription filters even
     # if the user's environment variables haven't changed.
     "VERSION" = 1
   }
+
+  event_rules = merge(
+    {
+      new_logs   = aws_cloudwatch_event_rule.new_log_groups
+      pagination = aws_cloudwatch_event_rule.pagination
+    },
+    var.defer_dormant_log_groups ? { dormant_log_groups = aws_cloudwatch_event_rule.dormant_log_groups[0] } : {},
+  )
+
+  # The subscription configuration is also passed to the custom resource, so that the
+  # Lambda function can compare it against the previous configuration on Update.
+  subscription_configuration = {
+    for k in [
+      "LOG_GROUP_MATCHES",
+      "LOG_GROUP_EXCLUDES",
+      "LOG_GROUP_TAG_SELECTORS",
+      "DESTINATION_ARN",
+      "DESTINATION_ARN_POOL",
+      "DELIVERY_STREAM_ROLE_ARN",
+      "FILTER_NAME",
+      "FILTER_PATTERN",
+      "ADDITIONAL_SUBSCRIPTIONS",
+      "VERSION",
+    ] : k => tostring(local.function_env_vars[k])
+  }
 }
 
 data "aws_caller_identity" "current" {}
@@ -57,6 +92,13 @@ resource "aws_iam_role_policy_attachment" "subscription_filter" {
   policy_arn = var.kinesis_firehose.firehose_iam_policy.arn
 }
 
+resource "aws_iam_role_policy_attachment" "additional_kinesis_firehoses" {
+  count = length(var.additional_kinesis_firehoses)
+
+  role       = regex(".*role/(?P<role_name>.*)$", local.subscription_filter_role_arn)["role_name"]
+  policy_arn = var.additional_kinesis_firehoses[count.index].firehose_iam_policy.arn
+}
+
 resource "aws_cloudwatch_log_group" "lambda" {
   name              = "/aws/lambda/${local.function_name}"
   retention_in_days = var.log_group_expiration_in_days
@@ -98,7 +140,8 @@ resource "aws_iam_policy" "lambda" {
               "logs:DescribeLogGroups",
               "logs:PutSubscriptionFilter",
               "logs:DescribeSubscriptionFilters",
-              "logs:DeleteSubscriptionFilter"
+              "logs:DeleteSubscriptionFilter",
+              "logs:ListTagsForResource"
             ],
             "Resource": "arn:${local.partition}:logs:${local.region}:${local.account}:log-group:*"
         },
@@ -108,7 +151,7 @@ resource "aws_iam_policy" "lambda" {
           "Action": [
             "iam:PassRole"
           ],
-          "Resource": "${local.subscription_filter_role_arn}"
+          "Resource": ${jsonencode(local.passed_role_arns)}
         },
         {
           "Sid": "",
@@ -139,6 +182,49 @@ resource "aws_iam_role_policy_attachment" "lambda" {
   policy_arn = aws_iam_policy.lambda.arn
 }
 
+resource "aws_dynamodb_table" "state" {
+  count = local.enable_state_table ? 1 : 0
+
+  name         = "${var.name}-state"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "key"
+
+  attribute {
+    name = "key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = var.tags
+}
+
+resource "aws_iam_role_policy" "state" {
+  count = local.enable_state_table ? 1 : 0
+
+  name_prefix = var.iam_name_prefix
+  role        = aws_iam_role.lambda.id
+  policy      = <<-EOF
+    {
+      "Version": "2012-10-17",
+      "Statement": [
+        {
+          "Effect": "Allow",
+          "Action": [
+            "dynamodb:GetItem",
+            "dynamodb:PutItem",
+            "dynamodb:DeleteItem"
+          ],
+          "Resource": "${aws_dynamodb_table.state[0].arn}"
+        }
+      ]
+    }
+  EOF
+}
+
 data "archive_file" "lambda_code" {
   type        = "zip"
   source_dir  = "${path.module}/lambda/"
@@ -169,7 +255,9 @@ resource "aws_lambda_function" "lambda" {
 
   depends_on = [
     aws_iam_role_policy_attachment.subscription_filter,
+    aws_iam_role_policy_attachment.additional_kinesis_firehoses,
     aws_iam_role_policy_attachment.lambda,
+    aws_iam_role_policy.state,
     aws_cloudwatch_log_group.lambda,
   ]
 }
@@ -204,11 +292,18 @@ resource "aws_cloudwatch_event_rule" "pagination" {
   tags = var.tags
 }
 
+resource "aws_cloudwatch_event_rule" "dormant_log_groups" {
+  count = var.defer_dormant_log_groups ? 1 : 0
+
+  name                = "${var.name}-dormant-log-groups"
+  description         = "Rule to periodically subscribe to deferred log groups that are no longer dormant"
+  schedule_expression = var.dormant_log_group_schedule
+
+  tags = var.tags
+}
+
 resource "aws_lambda_permission" "event_rules" {
-  for_each = {
-    new_logs   = aws_cloudwatch_event_rule.new_log_groups
-    pagination = aws_cloudwatch_event_rule.pagination
-  }
+  for_each = local.event_rules
 
   function_name = aws_lambda_function.lambda.function_name
   action        = "lambda:InvokeFunction"
@@ -217,10 +312,7 @@ resource "aws_lambda_permission" "event_rules" {
 }
 
 resource "aws_cloudwatch_event_target" "event_rules" {
-  for_each = {
-    new_logs   = aws_cloudwatch_event_rule.new_log_groups
-    pagination = aws_cloudwatch_event_rule.pagination
-  }
+  for_each = local.event_rules
 
   rule = each.value.name
 
@@ -229,7 +321,9 @@ resource "aws_cloudwatch_event_target" "event_rules" {
 }
 
 resource "aws_cloudformation_stack" "lambda_trigger" {
-  name = "${var.name}-${sha256(jsonencode(local.function_env_vars))}"
+  # The stack name is stable so that configuration changes update the custom resource
+  # in place, instead of deleting and re-creating every subscription filter.
+  name = "${var.name}-lambda-trigger"
 
   parameters = {
     "LambdaArn" = aws_lambda_function.lambda.arn
@@ -249,6 +343,7 @@ resource "aws_cloudformation_stack" "lambda_trigger" {
         Properties:
           Description: On stack creation, add subscriptions to all existing log groups that match the specified filters. On deletion, remove all subscriptions added by this template.
           ServiceToken: !Ref LambdaArn
+          Configuration: ${jsonencode(local.subscription_configuration)}
   EOF
 
   tags       = var.tags
@@ -15,6 +15,20 @@ variable "kinesis_firehose" {
   })
 }
 
+variable "additional_kinesis_firehoses" {
+  description = <<-EOF
+    Further Observe Kinesis Firehose modules among which log groups are spread, for accounts whose
+    logs exceed the throughput of a single delivery stream. If not empty, each log group is sent to
+    kinesis_firehose or one of these, chosen by consistent hashing of its name, so adding a delivery
+    stream only moves a proportional share of log groups to it.
+  EOF
+  type = list(object({
+    firehose_delivery_stream = object({ arn = string })
+    firehose_iam_policy      = object({ arn = string })
+  }))
+  default = []
+}
+
 variable "log_group_matches" {
   description = <<-EOF
     A list of regex patterns. If a Log Group fully matches any regex pattern in the list,
@@ -45,6 +59,37 @@ variable "log_group_excludes" {
   }
 }
 
+variable "additional_subscriptions" {
+  description = <<-EOF
+    Additional subscription filters managed by the same Lambda function, for example to also
+    send logs to an internal Kinesis stream. Each entry selects log groups with its own
+    log_group_matches and log_group_excludes. All entries share a single scan of the account's
+    log groups. If a log group runs out of subscription filter slots, the primary subscription
+    wins, followed by entries in list order. Every attribute is required, so set
+    log_group_tag_selectors to [] to select log groups by name only.
+  EOF
+  type = list(object({
+    destination_arn         = string
+    role_arn                = string
+    filter_name             = string
+    filter_pattern          = string
+    log_group_matches       = list(string)
+    log_group_excludes      = list(string)
+    log_group_tag_selectors = list(string)
+  }))
+  default = []
+}
+
+variable "log_group_tag_selectors" {
+  description = <<-EOF
+    A list of tag selectors, either "key=value" or "key" to match any value. If not empty, a Log Group
+    that passes log_group_matches and log_group_excludes is only subscribed to if it has a tag that
+    matches any selector.
+  EOF
+  type        = list(string)
+  default     = []
+}
+
 variable "filter_pattern" {
   description = <<-EOF
     The filter pattern that selects the log events that will be sent to Observe for each CloudWatch Logs group. To send all events, leave this empty (""). For more information, see [Filter and Pattern Syntax](https://docs.aws.amazon.com/AmazonCloudWatch/latest/logs/FilterAndPatternSyntax.html).
@@ -114,6 +159,34 @@ variable "ignore_delete_errors" {
   default     = false
 }
 
+variable "enable_state_table" {
+  description = <<-EOF
+    Create a DynamoDB table in which the Lambda function journals its progress. If the initial
+    subscription run times out, retrying or re-applying with the same configuration resumes from
+    the journal instead of revisiting every log group. Without the table, progress is only kept
+    in memory by warm Lambda execution environments.
+  EOF
+  type        = bool
+  default     = false
+}
+
+variable "defer_dormant_log_groups" {
+  description = <<-EOF
+    Do not subscribe to log groups that have never stored any data, such as those of unused Lambda
+    functions, when the module is applied. Instead, a scheduled rule invokes the Lambda function to
+    subscribe to them once they have. New log groups are always subscribed to. Deferred log groups
+    are remembered in the state table, which is created as if enable_state_table were set.
+  EOF
+  type        = bool
+  default     = false
+}
+
+variable "dormant_log_group_schedule" {
+  description = "Schedule expression of the rule that subscribes to deferred log groups that are no longer dormant"
+  type        = string
+  default     = "rate(1 hour)"
+}
+
 variable "tags" {
   description = "A map of tags to add to all resources"
   type        = map(string)